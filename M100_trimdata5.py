@@ -115,10 +115,10 @@ if True:
     r2q = '2.5704516191133808 1.4169106044781279 0.0011036963438420227 15.982205689901765 0.0'
     r3q = '0.5993522068193684 1.3645259947183588 -0.72602438926696777 8.8048715591430664 3561.9630360887845'
     r3  = '0.59935220681936829 1.3645259947183597 -0.72602438926696777 8.8048715591430664 3561.963036064973'
-    qac_stats(ms1q,r1q)
-    qac_stats(ms2q,r2q)
-    qac_stats(tp1q,r3q)
-    qac_stats(tp1,r3)
+    qac_stats(ms1q,r1q,eps=1e-9,cache=True)
+    qac_stats(ms2q,r2q,eps=1e-9,cache=True)
+    qac_stats(tp1q,r3q,cache=True)
+    qac_stats(tp1,r3,cache=True)
     print("Note the total flux includes all the data, including the fake guards")
 
 # 2024 regressions with 6.5.6
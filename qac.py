@@ -4,7 +4,7 @@
 #        Some are wrappers around CASA, others are also convenient for regression and performance testing.
 #
 
-import os, sys, shutil, math, tempfile, glob
+import os, sys, shutil, math, tempfile, glob, time
 import os.path
 import numpy as np
 import numpy.ma as ma
@@ -16,7 +16,7 @@ except:
     import pyfits as fits
 
 
-_version  = "28-oct-2024 for qac2024"
+_version  = "18-oct-2026 for qac2024"
 
 #                  only support casa6 here
 import casatools
@@ -87,11 +87,33 @@ def qac_project(projectdir, chdir=False):
         
     """
     print("QAC_PROJECT %s" % projectdir)
-    os.system('rm -rf %s ; mkdir -p %s' % (projectdir,projectdir))
+    QAC.rmasync(projectdir)
+    os.makedirs(projectdir)
     if chdir:
         os.chdir(projectdir)
     
     #-end of qac_project()
+
+def qac_rmimage(imagename):
+    """
+        remove all the tclean() products of imagename (imagename.image*, .pb*, .psf*, .weight*,
+        .workdirectory etc.), in the background (see QAC.rmasync).
+        Best called before tclean(), as leftovers from a previous run with e.g. a different
+        nchan will make it fail. Note that derived products, like imagename.image.pbcor and
+        imagename.image.mom0, are also removed.
+
+        Returns the list of removed files
+    """
+    exts = ['image', 'mask', 'model', 'psf', 'residual', 'pb', 'sumwt', 'weight', 'gridwt',
+            'alpha', 'beta', 'workdirectory']
+    removed = []
+    for ext in exts:
+        for f in glob.glob('%s.%s*' % (imagename, ext)):
+            QAC.rmasync(f)
+            removed.append(f)
+    return removed
+
+    #-end of qac_rmimage()
     
     
 def qac_tmp(prefix, tmpdir='.'):
@@ -103,11 +125,16 @@ def qac_tmp(prefix, tmpdir='.'):
            starting name of the filename in <tmpdir>/<pattern>
 
         tmpdir
+           directory, None means the scratch directory (see qac_scratch), if there is one
 
         Returns
         -------
         Unique filename
     """
+    if tmpdir == None:
+        tmpdir = QAC.scratchbase()
+        if tmpdir == None:
+            tmpdir = '.'
     fd = tempfile.NamedTemporaryFile(prefix=prefix,dir=tmpdir,delete='false')
     name = fd.name
     fd.close()
@@ -115,6 +142,66 @@ def qac_tmp(prefix, tmpdir='.'):
 
     #-end of qac_tmp()
 
+def qac_scratch(name, size=0, final=None, spill='.'):
+    """ Return a filename for an intermediate product on the scratch directory.
+        The scratch directory is $QAC_SCRATCH, else $TMPDIR, ideally a fast local disk (tmpfs, NVMe),
+        with a budget of $QAC_SCRATCH_MAX bytes (default: 80% of its free space).
+        If there is no scratch directory, or the budget would be exceeded, it spills to the project.
+
+        name      name of the product, which is also used in the spill directory
+        size      expected size in bytes, e.g. the size of the input (QAC.dirsize)
+        final     if given, the filename where the product should end up, see qac_scratch_done().
+                  Otherwise it is removed there.
+        spill     directory to use if the scratch directory cannot be used
+
+        Returns the filename to use
+    """
+    base = QAC.scratchbase()
+    path = None
+    if base != None:
+        budget = QAC.scratchmax
+        if budget == 0:
+            budget = 0.8 * shutil.disk_usage(base).free + QAC.dirsize(base)
+        if QAC.dirsize(base) + size <= budget:
+            QAC.scratchcount += 1
+            path = os.path.join(base, '%d.%s' % (QAC.scratchcount, os.path.basename(name.rstrip('/'))))
+    if path == None:
+        path = os.path.join(spill, name)
+        if base != None:
+            print("qac_scratch: %s spilled to %s" % (name, spill))
+    QAC.rmpath(path)
+    QAC.scratch[path] = final
+    return path
+
+    #-end of qac_scratch()
+
+def qac_scratch_done(path=None):
+    """ Finish with a qac_scratch() product, or with all of them (path=None).
+        A product that was declared final is moved to its final filename, all others are removed.
+        With path=None the scratch directory of this process is removed as well (qac_end() does this).
+    """
+    if path == None:
+        paths = list(QAC.scratch.keys())
+    else:
+        paths = [path]
+    for p in paths:
+        final = QAC.scratch.pop(p, None)
+        if not os.path.lexists(p):
+            continue
+        if final != None:
+            if os.path.abspath(p) != os.path.abspath(final):
+                QAC.rmasync(final)
+                shutil.move(p, final)
+            print("qac_scratch: %s -> %s" % (p, final))
+        else:
+            QAC.rmasync(p)
+    if path == None and QAC.scratchroot != None:
+        QAC.rmflush()
+        QAC.rmasync(QAC.scratchroot)
+        QAC.scratchroot = None
+
+    #-end of qac_scratch_done()
+
 def qac_image_desc(image, phasecenter=None, imsize=None, pixel=None):
     """
     Return image descriptors for QAC.
@@ -148,7 +235,8 @@ def qac_image_desc(image, phasecenter=None, imsize=None, pixel=None):
     #-end of qac_image_desc()
 
  
-def qac_im_ptg(phasecenter, imsize, pixel, grid, im=[], rect=True, factor=1.0, outfile=None):
+def qac_im_ptg(phasecenter, imsize, pixel, grid, im=[], rect=True, factor=1.0, outfile=None, maptype="HEX",
+               imradius=0.0):
     """
     Generate hex-grid of pointing centers that covers a specified area. 
     Can optionally output in file or as list. Can check for overlap with input image areas
@@ -157,7 +245,6 @@ def qac_im_ptg(phasecenter, imsize, pixel, grid, im=[], rect=True, factor=1.0, o
     conventions:  maptype = "HEX" or "ALMA". For "HEX" the base of the triangle is horizontal,
     for "ALMA" the base of the triangle is vertical. This is also the shortest distance between
     two pointings, which is supposed to to be FWHM/2 (nyquist)
-    Our qac_im_ptg() only has one convention: the "HEX" maptype (at least for now).
     
     Required Parameters
     -------------------
@@ -180,18 +267,27 @@ def qac_im_ptg(phasecenter, imsize, pixel, grid, im=[], rect=True, factor=1.0, o
                 
     Optional Parameters
     -------------------
-        im : list of strings @TODO
-            Input image file name(s) as a string or list of strings. This determines the area covered by the pointings.
+        im : list of strings
+            Input image file name(s) as a string or list of strings. This determines the area covered by the pointings:
+            only pointings on valid (finite, unmasked, non-zero) pixels in all images are kept (see qac_ptg_footprint)
             Example: im=["GBT.im", "VLA.im"]
             Default: empty
+        imradius : float
+            If > 0, a pointing is kept if there are valid pixels within about imradius arcsec in each image
+            Default: 0.0 (the pixel at the pointing itself needs to be valid)
         rect : boolean
             Indicates if only pointings within specified rectangular area will be reported
             Example: rect=False
             Default: True
         outfile : str
-            If present, used as name of output file 
+            If present, used as name of output file. If it ends in ".npy" a numpy (N,2) array
+            of RA,DEC in degrees is written, else a text file with one pointing per line.
+            See also QAC.ptgwrite()
             Example: outfile="FinalGBT.ptg"
             Default: None (not used, only list returned)
+        maptype : str
+            "HEX" (base of the triangle horizontal) or "ALMA" (base of the triangle vertical)
+            Default: "HEX"
     
     Returns
     -------
@@ -200,29 +296,30 @@ def qac_im_ptg(phasecenter, imsize, pixel, grid, im=[], rect=True, factor=1.0, o
     
     
     -- Arnab Dhabal - Feb 14, 2018
-
-    @todo  there are two ways to make a hex grid , point up or point at the side.
-           this routine cannot switch and puts the point at th side.
     
     """
     def hex(nring,grid):
-        coordlist = []
-        for row in range(-nring+1,nring,1):
-            y = 0.866025403 * grid * row
-            lo = 2-2*nring+abs(row)
-            hi = 2*nring-abs(row)-1
-            for k in range(lo,hi,2):
-                x = 0.5*grid*k
-                coords = [x,y]
-                coordlist.append((coords))
-        return coordlist
+        """ hex grid (x,y) coordinates, in rows of constant y, as two numpy arrays
+        """
+        row = np.arange(-nring+1,nring)[:,np.newaxis]
+        k = np.arange(2-2*nring,2*nring-1)[np.newaxis,:]
+        lo = 2-2*nring+np.abs(row)
+        hi = 2*nring-np.abs(row)-1
+        (row,k) = np.broadcast_arrays(row,k)
+        good = (k >= lo) & (k < hi) & ((k-lo) % 2 == 0)
+        return (0.5*grid*k[good], 0.866025403*grid*row[good])
+
+    # convert phasecenter into ra,dec in degree
+    phaseCenCoords = phasecenter.split(" ")
+    if (phaseCenCoords[1][-3:] == "deg") and (phaseCenCoords[2][-3:] == "deg"):
+        raDeg = float(phaseCenCoords[1][:-3])
+        decDeg = float(phaseCenCoords[2][:-3])
+    #print("RA:",raDeg, "Dec:",decDeg)
 
     #check the trivial case with no grid
     if grid <= 0.0:
         if outfile != None:
-            f= open(outfile,"w+")
-            f.write("%s\n" % phasecenter)
-            f.close()
+            QAC.ptgwrite(outfile, [phasecenter], [raDeg], [decDeg])
         return [phasecenter]
         
     #check if images is list or single file or none
@@ -233,17 +330,19 @@ def qac_im_ptg(phasecenter, imsize, pixel, grid, im=[], rect=True, factor=1.0, o
     else:
         im_list = [im]
 
-    # convert phasecenter into ra,dec in degree
-    phaseCenCoords = phasecenter.split(" ")
-    if (phaseCenCoords[1][-3:] == "deg") and (phaseCenCoords[2][-3:] == "deg"):
-        raDeg = float(phaseCenCoords[1][:-3])
-        decDeg = float(phaseCenCoords[2][:-3])
-    #print("RA:",raDeg, "Dec:",decDeg)
+    maptype = maptype.upper()
+    if maptype not in ["HEX", "ALMA"]:
+        print("qac_im_ptg: unknown maptype %s, use HEX or ALMA" % maptype)
+        return []
+
     cosdec = math.cos(decDeg*math.pi/180.0)
     
     imsize = QAC.imsize2(imsize)
     xim = imsize[0] * factor
     yim = imsize[1] * factor
+    if maptype == "ALMA":
+        # the ALMA grid is the HEX grid with x and y swapped
+        (xim, yim) = (yim, xim)
         
     if yim/xim > np.sqrt(3):
         maxim = yim/2.0
@@ -255,57 +354,70 @@ def qac_im_ptg(phasecenter, imsize, pixel, grid, im=[], rect=True, factor=1.0, o
         
     # print("rings:",nring)
 
-    xylist = hex(nring,grid)
-    ptgbool = [True]*len(xylist)
+    (x,y) = hex(nring,grid)
     #pointings only inside rect
     if(rect == True):
-        for xyi in np.arange(0,len(xylist),1):
-            if (xylist[xyi][0] > xim*pixel/2.0) or (xylist[xyi][0] < -xim*pixel/2.0) or (xylist[xyi][1] > yim*pixel/2.0) or (xylist[xyi][1] < -yim*pixel/2.0):
-                ptgbool[xyi] = False
-    
+        ptgbool = (np.abs(x) <= xim*pixel/2.0) & (np.abs(y) <= yim*pixel/2.0)
+    else:
+        ptgbool = np.ones(len(x), dtype=bool)
+    if maptype == "ALMA":
+        (x, y) = (y, x)
 
     #add phasecenter and generate J2000 deg pointings
-    ralist = [0.0]*len(xylist)
-    declist = [0.0]*len(xylist)
-    for xyi in np.arange(0,len(xylist),1):
-        ralist[xyi] = raDeg + xylist[xyi][0]/3600.0/cosdec
-        declist[xyi] = decDeg + xylist[xyi][1]/3600.0
+    ra  = raDeg + x/3600.0/cosdec
+    dec = decDeg + y/3600.0
     
-    #TODO: compare against each input file non-Nans
-#    for imi in im_list
-#        h0 = imhead(imi,mode='list')
-#        ia.open(imi)
-#        h1=ia.summary()
-#        ia.close()
-#        ??? = h0['...']
-#        for xyi in np.arange(0,len(xylist),1):
-#            if(... == np.nan):
-#                ptgbool[xyi]=False
-#        
-#        
+    #compare against each input file non-Nans
+    if len(im_list) > 0:
+        ptgbool &= qac_ptg_footprint(ra, dec, im_list, imradius)
+
     #generate final J2000 deg pointings
-    finalPtglist = []
-    if outfile == None:
-        for xyi in np.arange(0,len(xylist),1):
-            if ptgbool[xyi] == True:
-                strTemp = "J2000 " + str(round(ralist[xyi],6)) + "deg " + str(round(declist[xyi],6)) + "deg"
-                finalPtglist.append(strTemp)
-    else:
-        n=0
-        f= open(outfile,"w+")
-        for xyi in np.arange(0,len(xylist),1):
-            if ptgbool[xyi] == True:
-                n=n+1
-                strTemp = "J2000 " + str(round(ralist[xyi],6)) + "deg " + str(round(declist[xyi],6)) + "deg"
-                f.write("%s\n" % strTemp)
-                finalPtglist.append(strTemp)
-        f.close()
-        print("%d fields used in %s" % (n,outfile))
+    ra  = ra[ptgbool]
+    dec = dec[ptgbool]
+    finalPtglist = ["J2000 %sdeg %sdeg" % (str(round(r,6)), str(round(d,6))) for (r,d) in zip(ra.tolist(),dec.tolist())]
+    if outfile != None:
+        QAC.ptgwrite(outfile, finalPtglist, ra, dec)
+        print("%d fields used in %s" % (len(finalPtglist),outfile))
         
     return finalPtglist
 
     #-end of qac_im_ptg()
 
+def qac_ptg_footprint(ra, dec, images, radius=0.0):
+    """
+    Check which pointings fall on the footprint of one or more images.
+
+    ra, dec    arrays of pointing centers, in degrees
+    images     list of images (CASA or FITS)
+    radius     if > 0, a pointing is on the footprint if valid pixels are found within about
+               radius arcsec. Default: the pixel at the pointing itself needs to be valid.
+
+    Valid pixels are finite, unmasked and non-zero in at least one plane. The valid pixel
+    mask of each image is computed once per session (see QAC.footprint), after which each
+    pointing is just a lookup in a coarse occupancy grid.
+
+    Returns a boolean array, True for the pointings that are on the footprint of all images.
+    """
+    ra  = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    good = np.ones(len(ra), dtype=bool)
+    for image in images:
+        fp = QAC.footprint(image, radius)
+        (a0, d0) = fp['refval']
+        # SIN projection onto the pixel grid of the image
+        l = np.cos(dec) * np.sin(ra-a0)
+        m = np.sin(dec) * np.cos(d0) - np.cos(dec) * np.sin(d0) * np.cos(ra-a0)
+        x = np.rint(fp['refpix'][0] + l/fp['incr'][0]).astype(np.int64)
+        y = np.rint(fp['refpix'][1] + m/fp['incr'][1]).astype(np.int64)
+        inside = (x >= 0) & (x < fp['shape'][0]) & (y >= 0) & (y < fp['shape'][1])
+        ok = np.zeros(len(ra), dtype=bool)
+        ok[inside] = fp['grid'][x[inside] // fp['block'], y[inside] // fp['block']]
+        print("qac_ptg_footprint: %d/%d pointings on %s" % (ok.sum(), len(ok), image))
+        good &= ok
+    return good
+
+    #-end of qac_ptg_footprint()
+
 def qac_line(im):
     """
     return the line parameters for an image in terms of a dictionary for tclean()
@@ -329,7 +441,7 @@ def qac_line(im):
 
     #-end of qac_line()
 
-def qac_fits(image, outfile=None, box=None, chans=None, smooth=None, stats=False, channel=0):
+def qac_fits(image, outfile=None, box=None, chans=None, smooth=None, stats=False, channel=0, direct=False, nproc=1):
     """ exportfits shortcut, appends the extension ".fits" to a casa image
         also handles a list of images
 
@@ -339,6 +451,10 @@ def qac_fits(image, outfile=None, box=None, chans=None, smooth=None, stats=False
         chans     if set, use a 'chmin~chmax' in 0 based pixels
         smooth    if set, it is the number of arcsec (circular beam) it should be smoothed to
         stats     if set, also make a qac_plot and qac_stats
+        direct    if set, the box/chans are read into memory and written with astropy
+                  (see qac_fits_direct), without temporary CASA images.
+                  This is always used with smooth=, which then uses the FFT smoothing in QAC.smooth
+        nproc     in direct mode, the number of worker processes for a list of images
 
         Returns the (last) fits file  (@todo: should do a list if input is a list)
     
@@ -370,6 +486,30 @@ def qac_fits(image, outfile=None, box=None, chans=None, smooth=None, stats=False
     else:
         Qsubim = False
     fi = None
+    if direct or smooth != None:
+        jobs = []
+        for i in ii:
+            if not QAC.exists(i):
+                print("warning: %s does not exist" % i)
+                continue
+            fi = i + '.fits'
+            if len(ii)==1 and outfile!=None:
+                fi = outfile
+            jobs.append((i, fi, box, chans, getattr(QAC, 'keys', None), smooth))
+        if nproc > 1 and len(jobs) > 1:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=nproc, mp_context=multiprocessing.get_context('fork')) as pool:
+                list(pool.map(qac_fits_direct, *zip(*jobs)))
+        else:
+            for job in jobs:
+                qac_fits_direct(*job)
+        for job in jobs:
+            print("Wrote " + job[1])
+            if stats:
+                qac_stats(job[1])
+                qac_plot(job[1],mode=1,channel=channel)
+        return fi
     for i in ii:
         if not QAC.exists(i):
             print("warning: %s does not exist" % i)
@@ -378,32 +518,16 @@ def qac_fits(image, outfile=None, box=None, chans=None, smooth=None, stats=False
         fi = i + '.fits'
         if len(ii)==1 and outfile!=None:
             fi = outfile
-        if smooth != None:
-            tmpim1 = i + ".tmp1"
-            #print("smooth=%g" % smooth)
-            imsmooth(imagename=i,
-                     outfile=tmpim1,
-                     kernel='gauss',
-                     major='%garcsec' % smooth,
-                     minor='%garcsec' % smooth,                     
-                     pa='0deg',
-                     targetres=True,
-                     overwrite=True)
-        else:
-            tmpim1 = i
         if Qsubim:
-            tmpim2 = i + ".tmp2"
-            imsubimage(tmpim1,tmpim2,box=box,chans=chans,overwrite=True)
+            tmpim2 = qac_scratch(i + ".tmp2", QAC.dirsize(i))
+            imsubimage(i,tmpim2,box=box,chans=chans,overwrite=True)
             add_qac_history(tmpim2,idict)
             exportfits(tmpim2,fi,overwrite=True)
             #print("rm tmpim2")            
-            QAC.rmcasa(tmpim2)
+            qac_scratch_done(tmpim2)
         else:
-            add_qac_history(tmpim1,idict)            
-            exportfits(tmpim1,fi,overwrite=True)
-        if i != tmpim1:
-            #print("rm tmpim1")
-            QAC.rmcasa(tmpim1)
+            add_qac_history(i,idict)            
+            exportfits(i,fi,overwrite=True)
         print("Wrote " + fi)
         if stats:
             qac_stats(fi)
@@ -412,6 +536,109 @@ def qac_fits(image, outfile=None, box=None, chans=None, smooth=None, stats=False
 
     #-end of qac_fits()
 
+def qac_fits_direct(image, outfile, box=None, chans=None, history=None, smooth=None):
+    """ write (a box/channel range of) an image to FITS with astropy, reading just that
+        part into memory, and without writing temporary CASA images as exportfits() needs.
+
+        image     image name
+        outfile   output fits file name (overwritten)
+        box       if set, use a 'xmin,ymin,xmax,ymax' in 0 based pixels
+        chans     if set, use a 'chmin~chmax' in 0 based pixels
+        history   optional dictionary, written as "QAC key=val" HISTORY cards
+        smooth    if set, the resolution (arcsec) of a circular beam it should be smoothed to,
+                  or (major,minor,pa) in arcsec,arcsec,deg. Full planes are read and smoothed
+                  one at a time (see QAC.smooth) before the box is cut out.
+
+        Masked pixels are written as NaN. Returns the fits file name.
+    """
+    im = casatools.image()
+    im.open(image)
+    h = im.summary()
+    (blc,trc) = QAC.boxz(h['shape'], box)
+    zaxis = QAC.specaxis(h)
+    if chans != None and zaxis >= 0:
+        c = list(map(int, chans.split('~')))
+        blc[zaxis] = c[0]
+        trc[zaxis] = c[-1]
+    if smooth == None:
+        data = im.getchunk(blc, trc, dropdeg=False)
+        mask = im.getchunk(blc, trc, getmask=True, dropdeg=False)
+        if not mask.all():
+            data = np.where(mask, data, np.nan).astype(data.dtype)
+    else:
+        target = QAC.target(smooth)
+        perplane = 'beams' in h['restoringbeam']
+        jybeam = h['unit'].lower() == 'jy/beam'
+        planes = []
+        zrange = [blc[zaxis],trc[zaxis]] if zaxis >= 0 else None
+        for (b1,t1) in QAC.chunks(list(h['shape']), zaxis, zrange=zrange):
+            p = im.getchunk(b1, t1, dropdeg=False)
+            m = im.getchunk(b1, t1, getmask=True, dropdeg=False)
+            p = np.where(m, p, np.nan).astype(p.dtype)
+            p = QAC.smooth(p, h['incr'][:2], QAC.beam(im, b1[zaxis] if zaxis >= 0 else 0, perplane), target, jybeam)
+            planes.append(p[blc[0]:trc[0]+1, blc[1]:trc[1]+1])
+        data = np.concatenate(planes, axis=zaxis) if zaxis >= 0 else planes[0]
+    header = QAC.fitsheader(im, blc)
+    im.close()
+    if smooth != None:
+        header['BMAJ'] = target[0] * 180.0 / np.pi
+        header['BMIN'] = target[1] * 180.0 / np.pi
+        header['BPA']  = target[2] * 180.0 / np.pi
+    if history != None:
+        for k in history.keys():
+            header.add_history("QAC %s=%s" % (k,str(history[k])))
+    # casa [x,y,...] is the reverse of the numpy order in fits
+    fits.PrimaryHDU(data.T, header=header).writeto(outfile, overwrite=True)
+    return outfile
+
+    #-end of qac_fits_direct()
+
+def qac_smooth(image, outfile, major, minor=None, pa=0.0):
+    """ smooth an image to a target resolution with FFT convolution, one plane at a time,
+        as imsmooth(kernel='gauss',targetres=True) does. Per-plane beams are taken into account,
+        and the kernel transforms are cached, so smoothing several products to the same
+        resolution computes them only once.
+
+        image     input image
+        outfile   output CASA image, or a FITS file if it ends in ".fits" (see qac_fits_direct)
+        major     target major axis (arcsec)
+        minor     target minor axis (arcsec), default same as major
+        pa        target position angle (deg)
+
+        Returns the output file name
+    """
+    qac_tag("smooth")
+    if minor == None:
+        minor = major
+    if outfile.endswith('.fits'):
+        return qac_fits_direct(image, outfile, smooth=(major,minor,pa))
+    target = QAC.target((major,minor,pa))
+    im = casatools.image()
+    im.open(image)
+    h = im.summary()
+    shape = list(h['shape'])
+    zaxis = QAC.specaxis(h)
+    perplane = 'beams' in h['restoringbeam']
+    jybeam = h['unit'].lower() == 'jy/beam'
+    cs = im.coordsys()
+    io = casatools.image()
+    io.fromshape(outfile, shape=shape, csys=cs.torecord(), overwrite=True)
+    cs.done()
+    io.setbrightnessunit(h['unit'])
+    io.setrestoringbeam(major='%garcsec' % major, minor='%garcsec' % minor, pa='%gdeg' % pa)
+    for (blc,trc) in QAC.chunks(shape, zaxis):
+        p = im.getchunk(blc, trc, dropdeg=False)
+        m = im.getchunk(blc, trc, getmask=True, dropdeg=False)
+        p = np.where(m, p, np.nan).astype(p.dtype)
+        z = blc[zaxis] if zaxis >= 0 else 0
+        io.putchunk(QAC.smooth(p, h['incr'][:2], QAC.beam(im, z, perplane), target, jybeam), blc=blc)
+    io.close()
+    im.close()
+    print("Wrote " + outfile)
+    return outfile
+
+    #-end of qac_smooth()
+
 def qac_import(fits, cim, phasecenter=None, dec=None, order=None):
     """ import a fits, and optionally place it somewhere else on the sky
         ? why is indirection not working in simobserve ?
@@ -421,12 +648,14 @@ def qac_import(fits, cim, phasecenter=None, dec=None, order=None):
                 SHM: Why is this not an option in importfits()
     """
     if order != None:
-        infile = cim + '.tmp'
-        imtrans(fits,cim+'.tmp',order=order)
+        infile = qac_scratch(cim + '.tmp', QAC.dirsize(fits))
+        imtrans(fits,infile,order=order)
     else:
         infile = fits
         
     importfits(infile, cim, overwrite=True)
+    if infile != fits:
+        qac_scratch_done(infile)
     if phasecenter != None:
         print("phasecenter=%s to be applied" % phasecenter)
     if dec != None:
@@ -646,12 +875,867 @@ def qac_ingest(tp, tpout = None, casaworkaround=[1,3], ms=None, ptg=None):
 
     #-end of qac_ingest()
 
-def qac_stats_grid(images, **kwargs):
-    for image in images:
-        qac_stats(image, **kwargs)
+def qac_feather(highres, lowres, outfile, sdfactor=1.0, nthreads=4, benchmark=False):
+    """
+    Feather a high resolution (interferometer) and a low resolution (single dish) image in
+    the Fourier plane, as CASA's feather() does:
+
+         F(out) = F(high) * (1 - W(low))  +  sdfactor * F(low) * Omega(high)/Omega(low)
+
+    where W(low) is the Fourier transform of the low resolution beam (1 at the origin) and
+    Omega are the beam areas. Unlike feather(), beams are taken per plane if an image has
+    per-plane beams (see the ImageBeamSet assertion in TODO.md).
+
+    The cubes are streamed one channel at a time; batches of nthreads channels are
+    transformed (real FFTs) on a thread pool, and written one plane at a time.
+
+    highres      high resolution image, in Jy/beam
+    lowres       low resolution image, in Jy/beam, on the same grid (e.g. via imregrid)
+    outfile      output CASA image, with the beam(s) and units of highres
+    sdfactor     scale factor for the low resolution image
+    nthreads     number of threads, and number of channels per batch
+    benchmark    if True, also run CASA's feather() into outfile + '.casa' and report
+                 the runtimes and the flux difference
+
+    Returns the output image name, or None if the images are not on the same grid.
+    """
+    qac_tag("feather")
+    from concurrent.futures import ThreadPoolExecutor
+
+    t0 = time.time()
+    ih = casatools.image()
+    ih.open(highres)
+    il = casatools.image()
+    il.open(lowres)
+    hh = ih.summary()
+    hl = il.summary()
+    shape = list(hh['shape'])
+    if list(hl['shape']) != shape:
+        print("qac_feather: %s %s and %s %s do not have the same shape" % (highres, shape, lowres, list(hl['shape'])))
+        ih.close()
+        il.close()
+        return None
+    zaxis = QAC.specaxis(hh)
+    incr = hh['incr'][:2]
+    perh = 'beams' in hh['restoringbeam']
+    perl = 'beams' in hl['restoringbeam']
+
+    cs = ih.coordsys()
+    io = casatools.image()
+    io.fromshape(outfile, shape=shape, csys=cs.torecord(), overwrite=True)
+    cs.done()
+    io.setbrightnessunit(hh['unit'])
+    io.setrestoringbeam(imagename=highres)
+
+    def plane(dh, dl, bh, bl):
+        """ feather one plane, runs in a thread
+        """
+        bad = ~np.isfinite(dh)
+        fh = np.fft.rfft2(np.where(bad, 0.0, dh), axes=(0,1))
+        fl = np.fft.rfft2(np.nan_to_num(dl), axes=(0,1))
+        w = QAC.beamft(dh.shape[:2], incr, bl)
+        w = w.reshape(w.shape + (1,)*(dh.ndim-2))
+        f = fh * (1-w) + (sdfactor * bh[0]*bh[1] / (bl[0]*bl[1])) * fl
+        out = np.fft.irfft2(f, s=dh.shape[:2], axes=(0,1)).astype(dh.dtype)
+        out[bad] = np.nan
+        return out
+
+    chunks = list(QAC.chunks(shape, zaxis))
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        for i in range(0, len(chunks), nthreads):
+            batch = chunks[i:i+nthreads]
+            jobs = []
+            for (blc,trc) in batch:
+                z = blc[zaxis] if zaxis >= 0 else 0
+                jobs.append(pool.submit(plane,
+                                        ih.getchunk(blc, trc, dropdeg=False),
+                                        il.getchunk(blc, trc, dropdeg=False),
+                                        QAC.beam(ih, z, perh),
+                                        QAC.beam(il, z, perl)))
+            for ((blc,trc),job) in zip(batch, jobs):
+                io.putchunk(job.result(), blc=blc)
+    io.close()
+    ih.close()
+    il.close()
+    t1 = time.time() - t0
+    print("QAC_FEATHER: %s %d planes in %.2f sec" % (outfile, len(chunks), t1))
+
+    if benchmark:
+        out2 = outfile + '.casa'
+        QAC.rmcasa(out2)
+        t0 = time.time()
+        try:
+            feather(imagename=out2, highres=highres, lowres=lowres, sdfactor=sdfactor)
+            t2 = time.time() - t0
+            f1 = imstat(outfile)['flux'][0]
+            f2 = imstat(out2)['flux'][0]
+            print("QAC_FEATHER: qac_feather %.2f sec  feather %.2f sec  flux %s %s  rel.diff %g" %
+                  (t1, t2, repr(f1), repr(f2), (f1-f2)/f2))
+        except Exception as e:
+            print("QAC_FEATHER: CASA feather failed: %s" % str(e))
+    return outfile
+
+    #-end of qac_feather()
+
+def qac_moments(image, outfile, moments=['mom0','mom1'], chans=None, includepix=None, mask=None, fits=False):
+    """
+    Moment maps of a cube in one pass over the channels, replacing repeated immoments() calls.
+
+    image        input cube (CASA or FITS)
+    outfile      basename of the output maps, <outfile>.<moment> will be written, e.g.
+                 M100_combine_CO_cube.image.mom0 if outfile='M100_combine_CO_cube.image'
+    moments      list of moments:
+                   mom0      integrated intensity (unit * km/s)
+                   mom1      intensity weighted velocity (km/s)
+                   mom2      intensity weighted velocity dispersion (km/s)
+                   peak      peak intensity
+                   peakvel   velocity of the peak (km/s)
+    chans        if given, channel range 'chmin~chmax' (0 based, inclusive)
+    includepix   [min,max] range of pixel values used, for all moments, or a dictionary
+                 per moment, e.g.  {'mom0' : [2*rms,100], 'mom1' : [5.5*rms,100]}.
+                 peakvel uses the range of peak. Default: all pixels.
+    mask         LEL expression for a mask, e.g. "'M100_combine_CO_cube.pb'>0.3"
+    fits         if True, write FITS files (<outfile>.<moment>.fits) instead of CASA images
+
+    Velocities are in the radio convention, as used by tclean here.
+
+    Returns the list of output files.
+    """
+    qac_tag("moments")
+    im = casatools.image()
+    im.open(image)
+    h = im.summary()
+    shape = list(h['shape'])
+    zaxis = QAC.specaxis(h)
+    if zaxis < 0:
+        print("qac_moments: %s has no spectral axis" % image)
+        im.close()
+        return []
+    if chans != None:
+        zrange = list(map(int, chans.split('~')))
+        if len(zrange) == 1:
+            zrange = [zrange[0], zrange[0]]
+    else:
+        zrange = [0, shape[zaxis]-1]
+    if mask != None:
+        immask = casatools.image().imagecalc(outfile='', pixels='iif(%s,1.0,0.0)' % mask)
+    else:
+        immask = None
+
+    # radio velocities of the channels, in km/s
+    cs = im.coordsys()
+    rf = cs.restfrequency()['value'][0]
+    freq = h['refval'][zaxis] + (np.arange(shape[zaxis]) - h['refpix'][zaxis]) * h['incr'][zaxis]
+    vel = (1.0 - freq/rf) * _cms / 1000.0
+    dv = abs(h['incr'][zaxis] / rf) * _cms / 1000.0
+    vref = vel[zrange[0]:zrange[1]+1].mean()
+
+    # moments that share an includepix range share their accumulators
+    def inc(name):
+        if name == 'peakvel':
+            name = 'peak'
+        if type(includepix) == type({}):
+            r = includepix.get(name, None)
+        else:
+            r = includepix
+        if r == None:
+            return None
+        return (r[0], r[1])
+    acc = {}
+    for m in moments:
+        acc[inc(m)] = None
+
+    for blc,trc in QAC.chunks(shape, zaxis, zrange=zrange):
+        z = blc[zaxis]
+        d = im.getchunk(blc, trc, dropdeg=False)
+        good = np.isfinite(d) & im.getchunk(blc, trc, getmask=True, dropdeg=False)
+        if immask != None:
+            good &= immask.getchunk(blc, trc, dropdeg=False) > 0.5
+        v = vel[z] - vref
+        for key in acc.keys():
+            if acc[key] == None:
+                acc[key] = {'s0' : np.zeros(d.shape), 's1' : np.zeros(d.shape), 's2' : np.zeros(d.shape),
+                            'peak' : np.full(d.shape, -np.inf), 'peakvel' : np.full(d.shape, np.nan)}
+            a = acc[key]
+            if key == None:
+                sel = good
+            else:
+                sel = good & (d >= key[0]) & (d <= key[1])
+            dd = np.where(sel, d, 0.0)
+            a['s0'] += dd
+            a['s1'] += dd * v
+            a['s2'] += dd * v * v
+            upd = sel & (d > a['peak'])
+            a['peak'][upd] = d[upd]
+            a['peakvel'][upd] = vel[z]
+    if immask != None:
+        immask.done()
+
+    # output on the grid of the cube, with one channel at the center of the range
+    oshape = list(shape)
+    oshape[zaxis] = 1
+    refpix = cs.referencepixel()['numeric']
+    refpix[zaxis] -= 0.5 * (zrange[0] + zrange[1])
+    cs.setreferencepixel(value=refpix)
+    if 'beams' in h['restoringbeam']:
+        beam = im.restoringbeam(channel=(zrange[0]+zrange[1])//2, polarization=0)
+    else:
+        beam = im.restoringbeam()
+    im.close()
+    units = {'mom0' : h['unit'] + '.km/s', 'mom1' : 'km/s', 'mom2' : 'km/s', 'peak' : h['unit'], 'peakvel' : 'km/s'}
+
+    files = []
+    for m in moments:
+        a = acc[inc(m)]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            s0 = np.where(a['s0'] != 0, a['s0'], np.nan)
+            if m == 'mom0':
+                data = a['s0'] * dv
+            elif m == 'mom1':
+                data = vref + a['s1'] / s0
+            elif m == 'mom2':
+                data = np.sqrt(np.maximum(a['s2']/s0 - (a['s1']/s0)**2, 0.0))
+            elif m == 'peak':
+                data = np.where(np.isfinite(a['peak']), a['peak'], np.nan)
+            elif m == 'peakvel':
+                data = a['peakvel']
+            else:
+                print("qac_moments: skipping unknown moment %s" % m)
+                continue
+        io = casatools.image()
+        if fits:
+            fi = '%s.%s.fits' % (outfile, m)
+            io.fromshape('', shape=oshape, csys=cs.torecord(), overwrite=True)
+        else:
+            fi = '%s.%s' % (outfile, m)
+            io.fromshape(fi, shape=oshape, csys=cs.torecord(), overwrite=True)
+        io.putchunk(data.astype(np.float32))
+        io.setbrightnessunit(units[m])
+        if len(beam) > 0:
+            io.setrestoringbeam(beam=beam)
+        if fits:
+            io.tofits(fi, overwrite=True)
+        io.close()
+        files.append(fi)
+        print("Wrote " + fi)
+    cs.done()
+    return files
+
+    #-end of qac_moments()
+
+def qac_tp_prepare(tp, template, pb, outfile, box=None, regrid=None, pbout=None):
+    """
+    Prepare a TP cube for feathering in one pass: regrid (axes 0,1, bilinear) onto the grid of
+    a template image, cut out a box, and multiply by the pb. This replaces the
+    imregrid -> imsubimage -> immath(expr='IM0*IM1') sequence, which writes each intermediate
+    cube to disk.
+
+    tp         TP cube, e.g. 'M100_TP_CO_cube.spw3.image.bl'
+    template   image with the target grid, e.g. 'M100_combine_CO_cube.image'
+    pb         pb on the template grid, e.g. 'M100_combine_CO_cube.pb', with the same number
+               of channels as tp
+    outfile    output cube, the regridded TP times pb in the box, e.g. 'M100_TP_CO_cube.regrid.subim.depb'
+    box        'xmin,ymin,xmax,ymax' on the template grid, e.g. '219,148,612,579'. Default: whole image
+    regrid     if given, also write the regridded TP cube (before the pb multiply) in the box
+    pbout      if given, also write the pb in the box
+
+    The pixel mapping from the template to the TP grid is computed once, and applied plane by
+    plane to the box only. Pixels outside the TP image are NaN.
+    The output has the grid of the template (shifted to the box), and the beam and units of the TP.
+
+    Returns the output image name, or None if the number of channels do not match.
+    """
+    qac_tag("tp_prepare")
+    it = casatools.image()
+    it.open(tp)
+    ip = casatools.image()
+    ip.open(pb)
+    ht = it.summary()
+    hp = ip.summary()
+    tshape = list(ht['shape'])
+    pshape = list(hp['shape'])
+    zt = QAC.specaxis(ht)
+    zp = QAC.specaxis(hp)
+    nzt = tshape[zt] if zt >= 0 else 1
+    nzp = pshape[zp] if zp >= 0 else 1
+    if nzt != nzp:
+        print("qac_tp_prepare: %s has %d channels, %s has %d" % (tp, nzt, pb, nzp))
+        it.close()
+        ip.close()
+        return None
+    (blc,trc) = QAC.boxz(pshape, box)
+    (nx, ny) = (trc[0]-blc[0]+1, trc[1]-blc[1]+1)
+
+    # pixel mapping: box pixels -> world (template) -> TP pixels, computed once
+    cstpl = casatools.image()
+    cstpl.open(template)
+    ct = cstpl.coordsys()
+    cstpl.close()
+    (px, py) = np.meshgrid(np.arange(blc[0], trc[0]+1), np.arange(blc[1], trc[1]+1), indexing='ij')
+    pix = np.zeros((len(ct.referencepixel()['numeric']), nx*ny))
+    pix[0] = px.ravel()
+    pix[1] = py.ravel()
+    world = ct.toworldmany(pix)['numeric']
+    ct.done()
+    cs = it.coordsys()
+    wtp = np.array(cs.referencevalue()['numeric'], dtype=np.float64)[:,np.newaxis].repeat(nx*ny, axis=1)
+    wtp[0:2] = world[0:2]
+    tpix = cs.topixelmany(wtp)['numeric']
+    cs.done()
+    xt = tpix[0].reshape(nx, ny)
+    yt = tpix[1].reshape(nx, ny)
+    valid = (xt >= 0) & (xt <= tshape[0]-1) & (yt >= 0) & (yt <= tshape[1]-1)
+    x0 = np.clip(np.floor(xt).astype(np.int64), 0, tshape[0]-2)
+    y0 = np.clip(np.floor(yt).astype(np.int64), 0, tshape[1]-2)
+    fx = xt - x0
+    fy = yt - y0
+    w00 = (1-fx)*(1-fy)
+    w10 = fx*(1-fy)
+    w01 = (1-fx)*fy
+    w11 = fx*fy
+
+    # outputs on the grid of the pb, shifted to the box
+    oshape = list(pshape)
+    oshape[0] = nx
+    oshape[1] = ny
+    cp = ip.coordsys()
+    refpix = cp.referencepixel()['numeric']
+    refpix[0] -= blc[0]
+    refpix[1] -= blc[1]
+    cp.setreferencepixel(value=refpix)
+    outs = []
+    for (fi, unit) in [(outfile, ht['unit']), (regrid, ht['unit']), (pbout, hp['unit'])]:
+        if fi == None:
+            outs.append(None)
+            continue
+        io = casatools.image()
+        io.fromshape(fi, shape=oshape, csys=cp.torecord(), overwrite=True)
+        io.setbrightnessunit(unit)
+        if fi != pbout and len(ht['restoringbeam']) > 0:
+            io.setrestoringbeam(imagename=tp)
+        outs.append(io)
+    cp.done()
+
+    for z in range(nzp):
+        (b1, t1) = (list(blc), list(trc))
+        if zp >= 0:
+            b1[zp] = t1[zp] = z
+        d = ip.getchunk(b1, t1, dropdeg=False)
+        (bt, tt) = QAC.boxz(tshape)
+        if zt >= 0:
+            bt[zt] = tt[zt] = z
+        p = it.getchunk(bt, tt, dropdeg=False)
+        p = p.reshape(p.shape[0], p.shape[1], -1)[:,:,0]            # first stokes
+        r = p[x0,y0]*w00 + p[x0+1,y0]*w10 + p[x0,y0+1]*w01 + p[x0+1,y0+1]*w11
+        r[~valid] = np.nan
+        r = np.broadcast_to(r.reshape((nx,ny) + (1,)*(d.ndim-2)), d.shape).astype(np.float32)
+        if outs[0] != None:
+            outs[0].putchunk(r * d, blc=[0,0] + b1[2:])
+        if outs[1] != None:
+            outs[1].putchunk(r, blc=[0,0] + b1[2:])
+        if outs[2] != None:
+            outs[2].putchunk(d, blc=[0,0] + b1[2:])
+    for io in outs:
+        if io != None:
+            io.close()
+    it.close()
+    ip.close()
+    print("Wrote " + outfile)
+    return outfile
+
+    #-end of qac_tp_prepare()
+
+def qac_cache(task, outputs, inputs=None, **kwargs):
+    """
+    Run a pipeline stage (a CASA task or any function) through a content addressed artifact cache.
+    The key is a hash of the task name, the metadata of the input datasets (names, sizes and times
+    of all their files, see QAC.dsid) and the full parameter dictionary. On a miss the task is run
+    and its outputs are moved into the cache; on a hit the task is skipped. In both cases the
+    outputs are removed first (as the usual os.system('rm -rf ...') does) and symlinked from the cache.
+
+    task       the task, e.g. split or tclean, or its name, e.g. 'tclean'
+    outputs    output name, or list of names; glob patterns are allowed, e.g. prename + '.*' for tclean
+    inputs     list of input datasets. Default: all keyword values that are existing files or
+               directories (or lists of them), and are not outputs.
+    **kwargs   the parameters for the task
+
+    Since the outputs are symlinks into the cache, they should not be modified in place. The cache
+    lives in QAC.cachedir + '/artifacts', and is bounded by QAC.artifactmax bytes, evicting the
+    least recently used entries.
+
+    Example:
+        qac_cache(split, 'M100_12m_CO.ms', vis=vis12, outputvis='M100_12m_CO.ms', spw='0', field='M100',
+                  datacolumn='data', keepflags=False)
+        qac_cache(tclean, prename + '.*', vis=vis, imagename=prename, ...)
+
+    Returns what the task returned (on a hit, the json version of what it returned before).
+    """
+    import json, fnmatch
+    if type(outputs) == type(""):
+        outputs = [outputs]
+    if inputs == None:
+        inputs = []
+        for v in kwargs.values():
+            for f in (v if type(v) == type([]) else [v]):
+                if type(f) == type("") and os.path.exists(f) and f not in inputs:
+                    if not any([fnmatch.fnmatch(f, o) for o in outputs]):
+                        inputs.append(f)
+    if type(task) == type(""):
+        name = task
+        task = globals()[task]
+    else:
+        # CASA 6 tasks are instances (tclean = _tclean()), without a __name__
+        name = getattr(task, '__name__', type(task).__name__.lstrip('_'))
+    key = QAC.cachekey([name, [QAC.dsid(f) for f in inputs], kwargs])
+    adir = os.path.abspath(os.path.join(QAC.cachedir, 'artifacts', key))
+    manifest = os.path.join(adir, 'manifest.json')
+
+    for o in outputs:
+        for f in glob.glob(o):
+            QAC.rmpath(f)
+
+    if os.path.exists(manifest):
+        with open(manifest) as fp:
+            m = json.load(fp)
+        os.utime(manifest)
+        for (i,f) in enumerate(m['files']):
+            os.symlink(os.path.join(adir, 'data', str(i)), f)
+        print("QAC_CACHE: hit %s %s -> %s" % (name, key, m['files']))
+        return m['result']
+
+    qac_tag(name)
+    t0 = time.time()
+    result = task(**kwargs)
+    files = []
+    for o in outputs:
+        files = files + sorted([f for f in glob.glob(o) if f not in files])
+    QAC.rmpath(adir)
+    os.makedirs(os.path.join(adir, 'data'))
+    for (i,f) in enumerate(files):
+        shutil.move(f, os.path.join(adir, 'data', str(i)))
+        os.symlink(os.path.join(adir, 'data', str(i)), f)
+    with open(manifest + '.tmp', 'w') as fp:
+        json.dump({'task' : name, 'files' : files, 'inputs' : inputs, 'time' : time.time()-t0,
+                   'result' : result}, fp, default=str)
+    os.replace(manifest + '.tmp', manifest)
+    print("QAC_CACHE: miss %s %s -> %s" % (name, key, files))
+    QAC.artifactprune(keep=key)
+    return result
+
+    #-end of qac_cache()
+
+def qac_stage(name, task, inputs=[], outputs=[], **kwargs):
+    """
+    Define a stage for qac_pipeline()
+
+    name       unique name of the stage
+    task       the task (e.g. split), or its name (e.g. 'split')
+    inputs     list of files/directories this stage reads
+    outputs    list of files/directories this stage writes. They are removed before the stage runs.
+    **kwargs   parameters for the task
+
+    Example:
+        s1 = qac_stage('split12', split, [vis12], ['M100_12m_CO.ms'],
+                       vis=vis12, outputvis='M100_12m_CO.ms', spw='0', field='M100', datacolumn='data')
+    """
+    if type(task) != type(""):
+        # pass the task by name if we can, CASA tasks do not always pickle to a worker process
+        names = [k for (k,v) in globals().items() if v is task]
+        if len(names) > 0:
+            task = names[0]
+    return {'name' : name, 'task' : task, 'inputs' : list(inputs), 'outputs' : list(outputs), 'kwargs' : kwargs}
+
+    #-end of qac_stage()
+
+def qac_pipeline(stages, nproc=1, state='qac_pipeline.json', force=False):
+    """
+    Run a list of stages (see qac_stage) as a dependency graph: a stage depends on the stages
+    that produce its inputs. Stages whose dependencies are done run in parallel, in up to nproc
+    worker processes.
+
+    A stage is skipped if all its outputs exist and are newer than its inputs, and its
+    parameters did not change since it last finished (as recorded in the state file). This also
+    means a crashed pipeline resumes after the last finished stages. Stages that depend on a
+    failed stage are not run.
+
+    stages     list of stages
+    nproc      number of worker processes. With 1 everything runs in this process.
+    state      json file with the finished stages
+    force      if True, run all stages
+
+    Returns a dictionary with the status (done, skipped, failed, blocked) of each stage.
+    """
+    import json, multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+
+    def mtime(filename, newest=True):
+        """ newest (or oldest) mtime of anything in a file or directory tree
+        """
+        t = [os.stat(filename).st_mtime]
+        if os.path.isdir(filename):
+            for root, dirs, names in os.walk(filename):
+                t = t + [os.stat(os.path.join(root, n)).st_mtime for n in names]
+        return max(t) if newest else min(t)
+    def uptodate(st):
+        if not all([os.path.exists(o) for o in st['outputs']]) or len(st['outputs']) == 0:
+            return False
+        if st['name'] in finished and finished[st['name']]['key'] != keys[st['name']]:
+            return False
+        if len(st['inputs']) == 0:
+            return True
+        t_in  = max([mtime(i) for i in st['inputs'] if os.path.exists(i)] + [0])
+        t_out = min([mtime(o, False) for o in st['outputs']])
+        return t_out >= t_in
+
+    byname = {}
+    producer = {}
+    for st in stages:
+        byname[st['name']] = st
+        for o in st['outputs']:
+            producer[o] = st['name']
+    deps = {}
+    keys = {}
+    for st in stages:
+        deps[st['name']] = set([producer[i] for i in st['inputs'] if i in producer])
+        keys[st['name']] = QAC.cachekey([st['task'] if type(st['task']) == type("") else str(st['task']), st['kwargs']])
+    finished = {}
+    if os.path.exists(state):
+        with open(state) as fp:
+            finished = json.load(fp)
+
+    status = {}
+    pending = [st['name'] for st in stages]
+    running = {}
+    pool = None
+    if nproc > 1:
+        pool = ProcessPoolExecutor(max_workers=nproc, mp_context=multiprocessing.get_context('fork'))
+    t0 = time.time()
+    while len(pending) > 0 or len(running) > 0:
+        for name in list(pending):
+            st = byname[name]
+            if any([status.get(d) in ['failed', 'blocked'] for d in deps[name]]):
+                status[name] = 'blocked'
+                pending.remove(name)
+                print("QAC_PIPELINE: %s blocked" % name)
+                continue
+            if not all([status.get(d) in ['done', 'skipped'] for d in deps[name]]):
+                continue
+            pending.remove(name)
+            if not force and uptodate(st):
+                status[name] = 'skipped'
+                print("QAC_PIPELINE: %s up to date" % name)
+                continue
+            for o in st['outputs']:
+                QAC.rmpath(o)
+            print("QAC_PIPELINE: %s started" % name)
+            if pool != None:
+                job = pool.submit(qac_pipeline_run, st['task'], st['kwargs'])
+            else:
+                job = Future()
+                qac_tag_push(name)
+                try:
+                    job.set_result(qac_pipeline_run(st['task'], st['kwargs']))
+                except Exception as e:
+                    job.set_exception(e)
+                qac_tag_pop()
+            running[job] = name
+        if len(running) == 0:
+            for name in pending:
+                status[name] = 'blocked'
+                print("QAC_PIPELINE: %s can never run (circular dependency?)" % name)
+            break
+        (done, notdone) = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+        for job in done:
+            name = running.pop(job)
+            try:
+                dt = job.result()
+                status[name] = 'done'
+                finished[name] = {'key' : keys[name], 'time' : dt}
+                with open(state + '.tmp', 'w') as fp:
+                    json.dump(finished, fp, indent=1)
+                os.replace(state + '.tmp', state)
+                print("QAC_PIPELINE: %s done in %.2f sec" % (name, dt))
+            except Exception as e:
+                status[name] = 'failed'
+                print("QAC_PIPELINE: %s failed: %s" % (name, str(e)))
+    if pool != None:
+        pool.shutdown()
+    print("QAC_PIPELINE: %d stages in %.2f sec: %s" % (len(stages), time.time()-t0,
+          ' '.join(['%s=%s' % (n, status.get(n)) for n in byname.keys()])))
+    return status
+
+    #-end of qac_pipeline()
+
+def qac_pipeline_run(task, kwargs):
+    """ worker for qac_pipeline(): run one stage, and return its wall clock time
+    """
+    if type(task) == type(""):
+        task = globals()[task]
+    t0 = time.time()
+    task(**kwargs)
+    return time.time() - t0
+
+    #-end of qac_pipeline_run()
+
+def qac_clean_parallel(nproc=None, nchunk=None, keep=False, threads=None, **kwargs):
+    """
+    Run a specmode='cube' tclean() split in channel ranges, each in a separate (by default single
+    threaded, OMP_NUM_THREADS=1) CASA process on this node, and concatenate the chunks back into the usual
+    imagename.image, .pb, .residual, .model, .psf etc.
+
+    nproc      number of processes at the same time. Default: the procs of the qac_tune() profile
+               for tclean, if that tried more than one process, else the number of cores
+    nchunk     number of channel ranges. Default: nproc
+    threads    OMP_NUM_THREADS per process. Default: the threads of that same profile, else 1
+    keep       if True, keep the chunks (imagename.chunk<N>.*)
+    **kwargs   the tclean() parameters. specmode='cube', imagename, nchan, start and width are needed.
+               If restoringbeam='common', the concatenated .image is smoothed to the common beam of
+               all channels (see qac_smooth), and the .image.pbcor (if pbcor=True) is made again
+               from it. A mask image is cut into the same channel ranges.
+
+    Returns the list of concatenated images.
+    """
+    import json, subprocess
+    qac_tag("clean_parallel")
+    for k in ['imagename', 'nchan', 'start', 'width']:
+        if not k in kwargs or kwargs[k] == '':
+            print("qac_clean_parallel: %s= is required" % k)
+            return []
+    if kwargs.get('specmode', 'mfs') != 'cube':
+        print("qac_clean_parallel: only for specmode='cube'")
+        return []
+    imagename = kwargs['imagename']
+    if QAC.tuned('tclean', 'procs', 1) > 1:
+        if nproc == None:
+            nproc = QAC.tuned('tclean', 'procs')
+        if threads == None:
+            threads = QAC.tuned('tclean', 'threads', 1)
+    if nproc == None:
+        nproc = os.cpu_count()
+    if threads == None:
+        threads = 1
+    if nchunk == None:
+        nchunk = nproc
+
+    # one tclean per channel range
+    mask = kwargs.get('mask', '')
+    script = "import sys, json; from casatasks import tclean; tclean(**json.load(open(sys.argv[1])))"
+    env = dict(os.environ)
+    env['OMP_NUM_THREADS'] = str(threads)
+    names = []
+    procs = []
+    failed = []
+    chunks = QAC.chanchunks(kwargs, nchunk)
+    nchunk = len(chunks)
+    for (k, (c0, c1, kw)) in enumerate(chunks):
+        name = kw['imagename']
+        names.append(name)
+        for f in glob.glob(name + '.*'):
+            QAC.rmpath(f)
+        if type(mask) == type("") and mask != '' and QAC.iscasa(mask):
+            kw['mask'] = name + '.inmask'
+            imsubimage(mask, kw['mask'], chans='%d~%d' % (c0, c1-1), overwrite=True)
+        with open(name + '.json', 'w') as fp:
+            json.dump(kw, fp)
+        while len([p for p in procs if p.poll() == None]) >= nproc:
+            time.sleep(1)
+        print("qac_clean_parallel: chunk %d channels %d~%d start=%s" % (k, c0, c1-1, str(kw['start'])))
+        procs.append(subprocess.Popen([sys.executable, '-c', script, name + '.json'], env=env))
+    for (k,p) in enumerate(procs):
+        if p.wait() != 0:
+            failed.append(k)
+    if len(failed) > 0:
+        print("qac_clean_parallel: chunks %s failed" % str(failed))
+        return []
+
+    # concatenate along the spectral axis
+    exts = ['.image', '.pb', '.residual', '.model', '.psf', '.mask', '.sumwt', '.weight']
+    if kwargs.get('pbcor', False) and kwargs.get('restoringbeam', '') != 'common':
+        exts.append('.image.pbcor')
+    out = []
+    t = casatools.image()
+    t.open(names[0] + '.image')
+    zaxis = QAC.specaxis(t.summary())
+    t.close()
+    for ext in exts:
+        infiles = [n + ext for n in names]
+        if not all([QAC.exists(f) for f in infiles]):
+            continue
+        QAC.rmpath(imagename + ext)
+        cat = t.imageconcat(outfile=imagename + ext, infiles=infiles, axis=zaxis, relax=True, overwrite=True)
+        cat.done()
+        out.append(imagename + ext)
+
+    if kwargs.get('restoringbeam', '') == 'common':
+        t.open(imagename + '.image')
+        cb = t.commonbeam()
+        t.close()
+        os.rename(imagename + '.image', imagename + '.image.chans')
+        qac_smooth(imagename + '.image.chans', imagename + '.image',
+                   qa.convert(cb['major'],'arcsec')['value'],
+                   qa.convert(cb['minor'],'arcsec')['value'],
+                   qa.convert(cb['pa'],'deg')['value'])
+        QAC.rmpath(imagename + '.image.chans')
+        if kwargs.get('pbcor', False):
+            impbcor(imagename=imagename + '.image', pbimage=imagename + '.pb',
+                    outfile=imagename + '.image.pbcor', overwrite=True)
+            out.append(imagename + '.image.pbcor')
+    t.done()
+
+    if not keep:
+        for n in names:
+            for f in glob.glob(n + '.*'):
+                QAC.rmasync(f)
+    print("qac_clean_parallel: %d chunks -> %s" % (nchunk, ' '.join(out)))
+    return out
+
+    #-end of qac_clean_parallel()
+
+def qac_tune(task='tclean', threads=None, procs=[1], pin=True, **kwargs):
+    """
+    Find the best OMP_NUM_THREADS and number of processes for a CASA task on this host.
+    Each probe runs the task in separate CASA processes, with OMP_NUM_THREADS=threads and, if pin=True,
+    each process pinned to its own set of cores. The wall and CPU time of all probes are reported and
+    the fastest is stored for this host and task in QAC.tuneprofile, which qac_begin() will apply.
+
+    task       name of the casatasks task, e.g. 'tclean'
+    threads    list of OMP_NUM_THREADS to try. Default: 1,2,4,... up to the number of cores
+    procs      list of number of processes to try. More than 1 is only possible for a
+               specmode='cube' tclean, which is then split in channel ranges as in qac_clean_parallel()
+    pin        pin each process to threads cores?
+    **kwargs   the task parameters. They should describe a short probe, e.g. a few channels and a
+               small niter, of the real run. The imagename (or outfile) gets a .tune extension and
+               is removed after each probe.
+
+    Returns a list of dicts with task, threads, procs, wall, cpu and ok for each probe.
+    """
+    import json, subprocess, resource, socket
+    qac_tag("tune")
+    cores = sorted(os.sched_getaffinity(0))
+    ncores = len(cores)
+    if threads == None:
+        threads = [2**i for i in range(int(math.log2(ncores))+1)]
+        if threads[-1] != ncores:
+            threads.append(ncores)
+    script = "import sys, json, casatasks; getattr(casatasks, sys.argv[1])(**json.load(open(sys.argv[2])))"
+
+    kw = dict(kwargs)
+    for k in ['imagename', 'outfile']:
+        if k in kw:
+            kw[k] = kw[k] + '.tune'
+    results = []
+    for np1 in procs:
+        if np1 > 1 and not (task == 'tclean' and kw.get('specmode', 'mfs') == 'cube'):
+            print("qac_tune: procs=%d skipped, only a cube tclean can be split" % np1)
+            continue
+        for nt in threads:
+            if nt*np1 > ncores:
+                continue
+            if np1 > 1:
+                kws = [c[2] for c in QAC.chanchunks(kw, np1)]
+            else:
+                kws = [kw]
+            env = dict(os.environ)
+            env['OMP_NUM_THREADS'] = str(nt)
+            r0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+            t0 = time.time()
+            jobs = []
+            for (i, k1) in enumerate(kws):
+                for k in ['imagename', 'outfile']:
+                    if k in k1:
+                        for f in glob.glob(k1[k] + '*'):
+                            QAC.rmpath(f)
+                (fd, jfile) = tempfile.mkstemp(suffix='.json', prefix='qac_tune_')
+                with os.fdopen(fd, 'w') as fp:
+                    json.dump(k1, fp)
+                pcores = set(cores[i*nt:(i+1)*nt])
+                preexec = (lambda c=pcores: os.sched_setaffinity(0, c)) if pin else None
+                jobs.append((subprocess.Popen([sys.executable, '-c', script, task, jfile], env=env, preexec_fn=preexec), jfile))
+            ok = True
+            for (j, jfile) in jobs:
+                ok = ok and j.wait() == 0
+                os.remove(jfile)
+            wall = time.time() - t0
+            r1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = (r1.ru_utime - r0.ru_utime) + (r1.ru_stime - r0.ru_stime)
+            for k in ['imagename', 'outfile']:
+                if k in kw:
+                    for f in glob.glob(kw[k] + '*'):
+                        QAC.rmpath(f)       # not in the background, it would slow down the next probe
+            results.append({'task': task, 'threads': nt, 'procs': np1, 'wall': wall, 'cpu': cpu, 'ok': ok})
+            print("qac_tune: %s threads=%d procs=%d wall=%.2f cpu=%.2f %s" % (task, nt, np1, wall, cpu, "" if ok else "FAILED"))
+
+    good = [r for r in results if r['ok']]
+    if len(good) == 0:
+        print("qac_tune: no successful probes for %s" % task)
+        return results
+    best = dict(min(good, key=lambda r: r['wall']))
+    best['date'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    del best['ok']
+    host = socket.gethostname()
+    profile = {}
+    if os.path.exists(QAC.tuneprofile):
+        with open(QAC.tuneprofile) as fp:
+            profile = json.load(fp)
+    profile.setdefault(host, {})[task] = best
+    os.makedirs(os.path.dirname(QAC.tuneprofile), exist_ok=True)
+    tmp = '%s.%d' % (QAC.tuneprofile, os.getpid())
+    with open(tmp, 'w') as fp:
+        json.dump(profile, fp, indent=1)
+    os.replace(tmp, QAC.tuneprofile)
+    QAC.tuning[task] = best
+    print("qac_tune: best for %s on %s: OMP_NUM_THREADS=%d procs=%d (%.2f sec)" % (task, host, best['threads'], best['procs'], best['wall']))
+    return results
+
+    #-end of qac_tune()
+
+def qac_stats_grid(images, tests=None, nproc=1, outfile=None, **kwargs):
+    """ qac_stats() on a list of images, optionally in parallel
+
+        images    list of images (or measurement sets)
+        tests     optional list of regression strings, one per image (see qac_stats test=)
+        nproc     number of worker processes. Each image is done by one process, so the
+                  grid takes as long as the slowest image.
+        outfile   optional output table, a .json file or else a .csv file
+        **kwargs  passed to qac_stats()
+
+        Returns a table, as a list of dictionaries (one per image) with the qac_stats()
+        output, plus the wall clock time (sec) and bytes read for each image.
+    """
+    if tests == None:
+        tests = [None] * len(images)
+    jobs = list(zip(images, tests, [kwargs]*len(images)))
+    if nproc > 1 and len(jobs) > 1:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=nproc, mp_context=multiprocessing.get_context('fork')) as pool:
+            table = list(pool.map(qac_stats_row, *zip(*jobs)))
+    else:
+        table = [qac_stats_row(*job) for job in jobs]
+
+    if outfile != None:
+        QAC.writetable(table, outfile)
+    return table
+
+    #-end of qac_stats_grid()
+
+def qac_stats_row(image, test=None, kwargs={}):
+    """ worker for qac_stats_grid(): one image, with timing and I/O
+    """
+    io0 = QAC.iocount()
+    t0 = time.time()
+    row = qac_stats(image, test, **kwargs)
+    if row == None:
+        row = {'image' : image, 'test' : 'missing'}
+    row['time'] = time.time() - t0
+    row['bytes'] = QAC.iocount() - io0
+    return row
+
+    #-end of qac_stats_row()
     
     
-def qac_stats(image, test = None, eps=None, box=None, region=None, pb=None, pbcut=0.8, edge=False, sratio=True):
+def qac_stats(image, test = None, eps=None, box=None, region=None, pb=None, pbcut=0.8, edge=False, sratio=True,
+              stream=False, maxpix=None, flags=False, nproc=1, cache=False, history=None):
     """ summary of some stats in an image or measurement set
         in the latter case the flux is always reported as 0
 
@@ -671,8 +1755,26 @@ def qac_stats(image, test = None, eps=None, box=None, region=None, pb=None, pbcu
         sratio    also produce the Signal Ratio, defined as s=(FluxP-FluxN)/(FluxP+FluxN)
                   Flux = FluxP-FluxN  and FluxP/FluxN = (1-s)/(1+s)
                   FluxP = Flux * (1+s)/(2s)    FluxN = Flux * (1-s)/(2s)    
+        stream    if True, images are not handed to imstat() and read in full for sratio, but
+                  processed plane by plane in one bounded-memory pass (see qac_stats_stream).
+                  The numbers agree with imstat() to rounding, so use eps= for regression.
+                  region= is not supported in this mode, and will fall back to imstat()
+        maxpix    in stream mode, the maximum number of pixels per chunk (default: one plane)
+        flags     only for a measurement set: skip flagged data. The default (False) uses all data,
+                  as the historic regression strings did. Note the MS numbers are accumulated per
+                  field and row window (see qac_msstats), so they only agree with those strings to
+                  rounding: use eps= for a MS regression.
+        nproc     only for a measurement set: number of processes to read it (see qac_msstats)
+        cache     if True, results are kept in an on-disk cache (see QAC.cachedir), keyed on the
+                  dataset (names, sizes and times of all its files, also for the pb), the CASA and QAC
+                  versions, the code of the qac_stats functions (QAC.codehash), and the arguments that change the numbers. A repeat call on an unchanged
+                  dataset returns instantly.
+        history   if True, or a filename, the result is added to a SQLite history database
+                  (default QAC.historydb, also used when $QAC_HISTORY is set), see qac_history_add()
+                  and qac_history_compare(). Results from the cache are not added.
 
         Output should contain:   mean,rms,min,max,flux,[sratio]
+        Returns a dictionary with these (and image and test status), or None if the image is missing
 
         @todo   what when the .pb file is missing
     """
@@ -696,18 +1798,32 @@ def qac_stats(image, test = None, eps=None, box=None, region=None, pb=None, pbcu
     if not QAC.exists(image):
         print("QAC_STATS: missing %s " % image)
         return
+    t0 = time.time()
+
+    c0 = None
+    if cache:
+        pbfile = pb
+        if pbfile == None and '.' in image:
+            pbfile = image[:image.rindex('.')] + '.pb'
+        ckey = QAC.cachekey([QAC.dsid(image), QAC.dsid(pbfile), casatools.version_string(), _version,
+                             QAC.codehash([qac_stats, qac_stats_stream, qac_msstats, qac_msstats_rows]),
+                             box, region, pbcut, edge, sratio, stream, flags])
+        c0 = QAC.cacheget('stats', ckey)
     
-    if QAC.iscasa(image + '/ANTENNA'):                      # assume it's a MS
+    if c0 != None:                                          # cached
+        Qms  = c0['Qms']
+        mean = c0['mean']
+        rms  = c0['rms']
+        min  = c0['min']
+        max  = c0['max']
+        flux = c0['flux']
+    elif QAC.iscasa(image + '/ANTENNA'):                    # assume it's a MS
         Qms = True
-        tb.open(image)
-        data  = np.abs(tb.getcol('DATA')[0,:,:])  # first pol ->  data[nchan,nvis]
-        mean = data.mean()
-        rms  = data.std()
-        min  = data.min()
-        max  = data.max()
+        s0 = qac_msstats(image, flags=flags, nproc=nproc)
+        (mean, rms) = QAC.acc_stats(s0['all'], ddof=0)
+        min  = s0['all']['min']
+        max  = s0['all']['max']
         flux = 0.0
-        tb.close()
-        del data
     else:                                                   # assume it's an IM
         Qms = False
         maskarea = None
@@ -719,7 +1835,14 @@ def qac_stats(image, test = None, eps=None, box=None, region=None, pb=None, pbcu
                     maskarea = lel(pb) + '>' + str(pbcut)      # create a LEL for the mask
             else:
                 maskarea = lel(pb) + '>' + str(pbcut)
-        if edge:
+        if stream and region != None:
+            print("QAC_STATS: region= not supported in stream mode, using imstat()")
+            stream = False
+        if stream:
+            if maskarea == None:
+                pb = None
+            s0 = qac_stats_stream(image,box=box,pb=pb,pbcut=pbcut,edge=edge,maxpix=maxpix)
+        elif edge:
             nchan = imhead(image)['shape'][3]
             s0 = imstat(image,mask=maskarea,chans='1~%d' % (nchan-2),box=box,region=region)
         else:
@@ -758,17 +1881,27 @@ def qac_stats(image, test = None, eps=None, box=None, region=None, pb=None, pbcu
                 test_out = "FAILED regression delta=%g > %g" % (delta.max(),eps)
                 report = True
     if sratio and not Qms:
-        if QAC.iscasa(image,'Image'):
-            data = QAC.casa2np(image)
+        if c0 != None:
+            sratio = c0['sratio']
+        elif stream:
+            # already accumulated in the same pass
+            sratio = s0['sratio']
         else:
-            data = QAC.fits2np(image)
-        sump = data[data > 0.0].sum()
-        sumn = data[data < 0.0].sum()
-        sratio = (sump + sumn) / (sump - sumn)
+            if QAC.iscasa(image,'Image'):
+                data = QAC.casa2np(image)
+            else:
+                data = QAC.fits2np(image)
+            sump = data[data > 0.0].sum()
+            sumn = data[data < 0.0].sum()
+            sratio = (sump + sumn) / (sump - sumn)
         # print("SignalRatio: %g" % sratio)
         srat = str(sratio)
     else:
         srat = ""
+
+    if cache and c0 == None:
+        QAC.cacheput('stats', ckey, {'Qms' : Qms, 'mean' : mean, 'rms' : rms, 'min' : min, 'max' : max,
+                                     'flux' : flux, 'sratio' : sratio})
             
     msg1 = "QAC_STATS: %s" % (image)
     print("%s %s %s %s" % (msg1,test_new,srat,test_out))
@@ -776,8 +1909,510 @@ def qac_stats(image, test = None, eps=None, box=None, region=None, pb=None, pbcu
         fmt1 = '%%-%ds' % (len(msg1))
         msg2 = fmt1 % ' '
         print("%s %s EXPECTED" % (msg2,test))
+
+    if srat == "":
+        sratio = None
+    s1 = {'image' : image, 'mean' : mean, 'rms' : rms, 'min' : min, 'max' : max, 'flux' : flux,
+          'sratio' : sratio, 'test' : test_out}
+    if history == None and 'QAC_HISTORY' in os.environ:
+        history = True
+    if history and c0 != None:
+        print("QAC_STATS: %s from the cache, not added to the history" % image)
+    elif history:
+        qac_history_add(s1, time.time() - t0, db=None if history == True else history)
+    return s1
     
     #-end of qac_stats()
+
+def qac_history_add(s1, wall=None, db=None):
+    """ add a qac_stats() result to the SQLite history database, keyed by dataset, CASA version and host.
+        Also stored are the wall time of qac_stats, and the stage (see qac_tag_push) with
+        its wall time and peak memory (RSS of this process, see QACtime.stagepeak) so far.
+
+        s1        the dictionary returned by qac_stats()
+        wall      time spent in qac_stats
+        db        database file. Default: QAC.historydb
+    """
+    import sqlite3, socket, resource
+    if db == None:
+        db = QAC.historydb
+    try:
+        casa = casatools.version_string()
+    except:
+        casa = 'unknown'
+    stage = None
+    stagewall = None
+    if QAC.hasdt():
+        stage = '/'.join([QAC.dt.label] + QAC.dt.stages)
+        stagewall = time.time() - QAC.dt.t0 - QAC.dt.start[-1]['t']
+    if QAC.hasdt():
+        peak = QAC.dt.stagepeak()
+    else:
+        peak = QAC.vmstat('VmHWM')
+    if peak == 0:
+        peak = 1024 * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    dirname = os.path.dirname(db)
+    if dirname != '':
+        os.makedirs(dirname, exist_ok=True)
+    con = sqlite3.connect(db, timeout=60)
+    with con:
+        con.execute(QAC.historysql)
+        con.execute('CREATE INDEX IF NOT EXISTS stats_key ON stats (dataset, casa, host)')
+        con.execute('INSERT INTO stats (dataset, casa, host, date, stage, mean, rms, min, max, flux, sratio, '
+                    'wall, stagewall, peak) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                    (os.path.normpath(s1['image']), casa, socket.gethostname(), time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     stage, float(s1['mean']), float(s1['rms']), float(s1['min']), float(s1['max']), float(s1['flux']),
+                     None if s1['sratio'] == None else float(s1['sratio']), wall, stagewall, peak))
+    con.close()
+
+    #-end of qac_history_add()
+
+def qac_history_compare(v1=None, v2=None, dataset=None, host=None, eps=1e-6, slowdown=1.2, db=None):
+    """ compare the qac_stats() history of two CASA versions, per dataset and host.
+        For each the latest entry of either version is used.
+
+        v1, v2     CASA versions, e.g. '6.5.6.22'. Default: for each dataset/host the two last
+                   versions seen, v1 being the older one
+        dataset    if given, only this dataset
+        host       if given, only this host. Default: all hosts
+        eps        flag a regression if one of mean,rms,min,max,flux,sratio differs more than eps
+                   (relative, as in qac_stats, but absolute if the old value was 0)
+        slowdown   flag a slowdown if the stage (or else qac_stats) wall time, or the peak memory,
+                   grew by more than this factor
+        db         database file. Default: QAC.historydb
+
+        Returns a list of dictionaries, one per comparison, with the flagged fields
+    """
+    import sqlite3
+    if db == None:
+        db = QAC.historydb
+    if not os.path.exists(db):
+        print("QAC_HISTORY: no history in %s" % db)
+        return []
+    con = sqlite3.connect(db, timeout=60)
+    con.row_factory = sqlite3.Row
+    rows = [dict(r) for r in con.execute('SELECT * FROM stats ORDER BY id')]
+    con.close()
+    groups = {}
+    for r in rows:
+        if dataset != None and r['dataset'] != os.path.normpath(dataset):
+            continue
+        if host != None and r['host'] != host:
+            continue
+        g = groups.setdefault((r['dataset'], r['host']), {})
+        g.pop(r['casa'], None)                  # keep the versions in order of their last entry
+        g[r['casa']] = r
+    results = []
+    for ((ds, hs), g) in groups.items():
+        if v1 == None or v2 == None:
+            if len(g) < 2:
+                continue
+            (c1, c2) = list(g.keys())[-2:]
+        else:
+            (c1, c2) = (v1, v2)
+        if not c1 in g or not c2 in g:
+            continue
+        (r1, r2) = (g[c1], g[c2])
+        flags = []
+        for k in ['mean', 'rms', 'min', 'max', 'flux', 'sratio']:
+            if r1[k] == None or r2[k] == None:
+                continue
+            d = abs(r2[k] - r1[k])
+            if r1[k] != 0:
+                d = d / abs(r1[k])              # relative, unless the old value is 0
+            if d > eps:
+                flags.append('%s=%g' % (k, d))
+        if r1['stagewall'] and r2['stagewall']:
+            times = ['stagewall', 'peak']
+        else:
+            times = ['wall', 'peak']
+        for k in times:
+            if r1[k] and r2[k] and r2[k] > slowdown * r1[k]:
+                flags.append('%s*%.2f' % (k, r2[k] / r1[k]))
+        r = {'dataset' : ds, 'host' : hs, 'v1' : c1, 'v2' : c2, 'flags' : flags}
+        results.append(r)
+        print("QAC_HISTORY: %s %s %s -> %s %s" % (ds, hs, c1, c2, ' '.join(flags) if len(flags) > 0 else 'OK'))
+    return results
+
+    #-end of qac_history_compare()
+
+def qac_stats_stream(image, box=None, pb=None, pbcut=0.8, edge=False, maxpix=None):
+    """ statistics of an image (CASA or FITS) in one bounded-memory pass
+        The image is read plane by plane (or in tiles of rows if maxpix is given), never in full,
+        so cubes larger than memory can be used.
+
+        image     image file name
+        box       if used, 'xmin,ymin,xmax,ymax' in 0 based pixels (inclusive, as imstat)
+        pb        optional pb file, pixels with pb <= pbcut are not used
+        pbcut     cutoff value for the pb
+        edge      skip the first and last channel
+        maxpix    maximum number of pixels per chunk (default: one plane)
+
+        Returns a dictionary with the imstat() names, as 1-element arrays:
+              npts, sum, mean, sigma, min, max, and flux (if the units allow it),
+        plus the signal ratio sratio, which (like qac_stats) is taken over all finite pixels
+        of the image, ignoring box, pb and edge.
+    """
+    im = casatools.image()
+    im.open(image)
+    h = im.summary()
+    shape = list(h['shape'])
+    zaxis = QAC.specaxis(h)
+    if zaxis < 0:
+        nz = 1
+    else:
+        nz = shape[zaxis]
+    if box != None:
+        b = QAC.iarray(box)
+    else:
+        b = None
+    if pb != None:
+        impb = casatools.image()
+        impb.open(pb)
+    else:
+        impb = None
+
+    # flux needs the beam area (per plane if need be), and a cube is integrated over velocity
+    bunit = h['unit'].lower()
+    perplane = 'beams' in h['restoringbeam']
+    bpix = {}
+    dv = 1.0
+    if zaxis >= 0 and nz > 1 + 2*int(edge):
+        try:
+            cs = im.coordsys()
+            df = cs.increment(type='spectral')['numeric'][0]
+            rf = cs.restfrequency()['value'][0]
+            cs.done()
+            dv = abs(df/rf) * _cms / 1000.0
+        except:
+            print("QAC_STATS: no restfreq for %s, flux not integrated over km/s" % image)
+
+    acc = QAC.acc_init()
+    sump = 0.0
+    sumn = 0.0
+    flux = 0.0
+    for blc,trc in QAC.chunks(shape, zaxis, maxpix):
+        data = im.getchunk(blc, trc, dropdeg=False)
+        good = np.isfinite(data)
+        d = data[good]
+        sump += d[d > 0.0].sum()
+        sumn += d[d < 0.0].sum()
+        if zaxis >= 0:
+            z = blc[zaxis]
+            if edge and (z == 0 or z == nz-1):
+                continue
+        else:
+            z = 0
+        sel = good & im.getchunk(blc, trc, getmask=True, dropdeg=False)
+        if b != None:
+            inbox = np.zeros(data.shape[:2], dtype=bool)
+            inbox[b[0]:b[2]+1, max(b[1]-blc[1],0):max(b[3]+1-blc[1],0)] = True
+            sel &= inbox.reshape(inbox.shape + (1,)*(data.ndim-2))
+        if impb != None:
+            sel &= impb.getchunk(blc, trc, dropdeg=False) > pbcut
+        d = data[sel]
+        acc = QAC.acc_add(acc, d)
+        if bunit == 'jy/beam':
+            if not z in bpix:
+                bpix[z] = im.beamarea(channel=z if perplane else -1, polarization=-1)['pixels']
+            flux += acc['last'] / bpix[z]
+        elif bunit == 'jy/pixel':
+            flux += acc['last']
+    im.close()
+    if impb != None:
+        impb.close()
+
+    (mean, sigma) = QAC.acc_stats(acc)
+    s0 = {'npts'  : np.array([acc['n']]),
+          'sum'   : np.array([acc['sum']]),
+          'mean'  : np.array([mean]),
+          'sigma' : np.array([sigma]),
+          'min'   : np.array([acc['min']]),
+          'max'   : np.array([acc['max']])}
+    if bunit in ['jy/beam', 'jy/pixel']:
+        s0['flux'] = np.array([flux * dv])
+    s0['sratio'] = (sump + sumn) / (sump - sumn)
+    return s0
+
+    #-end of qac_stats_stream()
+
+def qac_chanstats(image, box=None, chans=None, pb=None, pbcut=0.8, linefree=False, nsigma=6.0):
+    """ per-channel statistics of a cube in one sequential pass, one plane in memory at a time.
+        This replaces repeated imstat(chans=) calls, e.g. to find the rms in line free channels.
+
+        image     image file name (CASA or FITS)
+        box       if used, 'xmin,ymin,xmax,ymax' in 0 based pixels (inclusive, as imstat)
+        chans     if used, 'chmin~chmax' in 0 based channels
+        pb        optional pb file, pixels with pb <= pbcut are not used
+        pbcut     cutoff value for the pb
+        linefree  if True, select the line free channels: those where the peak absolute value is
+                  below nsigma times the robust (MAD based) sigma of that channel
+        nsigma    threshold for linefree
+
+        Returns a dictionary of arrays, one value per channel:
+              chan, npts, sum, rms, sigma, mad, min, max
+        (rms is the root mean square, as in imstat, mad is the MAD based robust sigma)
+        and, if linefree was set, the boolean array 'linefree' and
+        'noise', the mean rms over the line free channels
+
+        Example:  rms = qac_chanstats('M100_combine_CO_cube.image', linefree=True)['noise']
+    """
+    im = casatools.image()
+    im.open(image)
+    h = im.summary()
+    shape = list(h['shape'])
+    zaxis = QAC.specaxis(h)
+    if chans != None and zaxis >= 0:
+        zrange = list(map(int, chans.split('~')))
+        if len(zrange) == 1:
+            zrange = [zrange[0], zrange[0]]
+    else:
+        zrange = None
+    if pb != None:
+        impb = casatools.image()
+        impb.open(pb)
+    else:
+        impb = None
+
+    keys = ['chan', 'npts', 'sum', 'rms', 'sigma', 'mad', 'min', 'max']
+    s0 = {}
+    for k in keys:
+        s0[k] = []
+    for blc,trc in QAC.chunks(shape, zaxis, zrange=zrange):
+        data = im.getchunk(blc, trc, dropdeg=False)
+        sel = np.isfinite(data) & im.getchunk(blc, trc, getmask=True, dropdeg=False)
+        if box != None:
+            (b0,b1) = QAC.boxz(data.shape, box)
+            inbox = np.zeros(data.shape[:2], dtype=bool)
+            inbox[b0[0]:b1[0]+1, b0[1]:b1[1]+1] = True
+            sel &= inbox.reshape(inbox.shape + (1,)*(data.ndim-2))
+        if impb != None:
+            sel &= impb.getchunk(blc, trc, dropdeg=False) > pbcut
+        d = data[sel].astype(np.float64)
+        s0['chan'].append(blc[zaxis] if zaxis >= 0 else 0)
+        s0['npts'].append(d.size)
+        if d.size == 0:
+            for k in keys[2:]:
+                s0[k].append(np.nan)
+            continue
+        s0['sum'].append(d.sum())
+        s0['rms'].append(np.sqrt((d*d).mean()))
+        s0['sigma'].append(d.std(ddof=1) if d.size > 1 else 0.0)
+        s0['mad'].append(1.4826 * np.median(np.abs(d - np.median(d))))
+        s0['min'].append(d.min())
+        s0['max'].append(d.max())
+    im.close()
+    if impb != None:
+        impb.close()
+    for k in keys:
+        s0[k] = np.array(s0[k])
+
+    if linefree:
+        peak = np.maximum(np.abs(s0['min']), np.abs(s0['max']))
+        s0['linefree'] = peak < nsigma * s0['mad']
+        if s0['linefree'].sum() > 0:
+            s0['noise'] = s0['rms'][s0['linefree']].mean()
+        else:
+            print("QAC_CHANSTATS: warning, no line free channels found in %s" % image)
+            s0['noise'] = np.nan
+        print("QAC_CHANSTATS: %s %d channels, %d line free, noise %s" %
+              (image, len(s0['chan']), s0['linefree'].sum(), repr(s0['noise'])))
+    return s0
+
+    #-end of qac_chanstats()
+
+def qac_msstats(ms, nrow=10000, flags=True, nproc=1, verbose=True):
+    """ amplitude statistics of the first polarization of the DATA column of a measurement set,
+        read in windows of nrow rows, so memory use is bounded by nrow (not by the size of the MS).
+
+        ms        measurement set
+        nrow      number of rows read per getcol()
+        flags     if True, skip data flagged in FLAG or FLAG_ROW
+        nproc     if > 1, row windows are spread over this many processes
+        verbose   if True, print a QAC_MSSTATS line per spw/field
+
+        Returns a dictionary of running accumulators (see QAC.acc_stats), with key 'all' for the
+        whole MS, and keys (spw,field) for the breakdown. Each also has 'nflag', the number
+        of skipped flagged values.
+    """
+    t = casatools.table()
+    t.open(ms + '/DATA_DESCRIPTION')
+    dd2spw = t.getcol('SPECTRAL_WINDOW_ID')
+    t.close()
+    t.open(ms + '/FIELD')
+    fnames = t.getcol('NAME')
+    t.close()
+    t.open(ms)
+    ddids = t.getcol('DATA_DESC_ID')
+    t.close()
+    # each DATA_DESC_ID has a fixed shape, so we window over them separately
+    jobs = []
+    for ddid in np.unique(ddids):
+        nrows = (ddids == ddid).sum()
+        for r0 in range(0, nrows, nrow):
+            jobs.append((ms, int(ddid), r0, min(nrow, nrows-r0), flags, len(ddids) == nrows))
+    del ddids
+
+    if nproc > 1 and len(jobs) > 1:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=nproc, mp_context=multiprocessing.get_context('fork')) as pool:
+            results = list(pool.map(qac_msstats_rows, *zip(*jobs)))
+    else:
+        results = [qac_msstats_rows(*job) for job in jobs]
+
+    s0 = {'all' : QAC.acc_init()}
+    s0['all']['nflag'] = 0
+    for (job, r) in zip(jobs, results):
+        spw = int(dd2spw[job[1]])
+        for fid in r.keys():
+            key = (spw, fnames[fid])
+            if not key in s0:
+                s0[key] = QAC.acc_init()
+                s0[key]['nflag'] = 0
+            for k in [key, 'all']:
+                nflag = s0[k]['nflag'] + r[fid]['nflag']
+                s0[k] = QAC.acc_merge(s0[k], r[fid])
+                s0[k]['nflag'] = nflag
+    if verbose:
+        for key in sorted([k for k in s0.keys() if k != 'all']):
+            (mean, rms) = QAC.acc_stats(s0[key], ddof=0)
+            print("QAC_MSSTATS: %s spw=%d field=%s %s %s %s %s %d %d" %
+                  (ms, key[0], key[1], repr(mean), repr(rms), repr(s0[key]['min']), repr(s0[key]['max']),
+                   s0[key]['n'], s0[key]['nflag']))
+    return s0
+
+    #-end of qac_msstats()
+
+def qac_msstats_rows(ms, ddid, startrow, nrow, flags=True, whole=False):
+    """ worker for qac_msstats(): accumulate the amplitudes of one row window of one DATA_DESC_ID
+        whole     if True, the MS has only this DATA_DESC_ID and no selection is needed
+
+        Returns a dictionary, keyed by FIELD_ID, of accumulators
+    """
+    t = casatools.table()
+    t.open(ms)
+    if whole:
+        t1 = t
+    else:
+        t1 = t.query('DATA_DESC_ID==%d' % ddid)
+    data = np.abs(t1.getcol('DATA', startrow, nrow)[0,:,:])     # first pol -> data[nchan,nrow]
+    fids = t1.getcol('FIELD_ID', startrow, nrow)
+    if flags:
+        good = ~t1.getcol('FLAG', startrow, nrow)[0,:,:]
+        good &= ~t1.getcol('FLAG_ROW', startrow, nrow)[np.newaxis,:]
+    if not whole:
+        t1.close()
+    t.close()
+    r = {}
+    for fid in np.unique(fids):
+        rows = fids == fid
+        d = data[:,rows]
+        if flags:
+            g = good[:,rows]
+            r[int(fid)] = QAC.acc_add(QAC.acc_init(), d[g])
+            r[int(fid)]['nflag'] = int(g.size - g.sum())
+        else:
+            r[int(fid)] = QAC.acc_add(QAC.acc_init(), d)
+            r[int(fid)]['nflag'] = 0
+    return r
+
+    #-end of qac_msstats_rows()
+
+def qac_bench(sizes=[64,128,256], funcs=None, tmpdir=None, outfile='qac_bench.json', label='', keep=False):
+    """ benchmark qac functions on synthetic data of increasing size
+
+        sizes     list of sizes. An integer n means a n x n x n/4 cube (and an MS with n*n/4 rows
+                  of n/4 channels), or give [nx,ny,nz] explicitly
+        funcs     list of benchmarks to run. Default: all of
+                  'stats', 'stats_fits', 'stats_ms', 'fits', 'im_ptg', 'image_desc', 'line', 'ingest'
+        tmpdir    directory for the synthetic data. Default: a new directory in $TMPDIR
+        outfile   json file with the results
+        label     free format label to identify this run, e.g. the git commit
+        keep      if True, keep the synthetic data
+
+        Each benchmark runs in a forked process, so the peak memory (VmHWM) is that of only this
+        function, including the memory used by the CASA tools.
+        Returns the list of results, one dictionary per function and size, with the wall and cpu
+        time (sec), bytes read, peak and start memory (bytes).
+    """
+    import json, socket, multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    all_funcs = ['stats', 'stats_fits', 'stats_ms', 'fits', 'im_ptg', 'image_desc', 'line', 'ingest']
+    if funcs == None:
+        funcs = all_funcs
+    if tmpdir == None:
+        tmpdir = tempfile.mkdtemp(prefix='qac_bench_')
+    os.makedirs(tmpdir, exist_ok=True)
+
+    results = []
+    for size in sizes:
+        if type(size) == type(0):
+            size = [size, size, max(1, size//4)]
+        (nx, ny, nz) = size
+        base = os.path.join(tmpdir, 'bench_%dx%dx%d' % (nx, ny, nz))
+        cube = base + '.im'
+        QAC.synthcube(cube, nx, ny, nz, fits=base + '.fits')
+        ms = base + '.ms'
+        if 'stats_ms' in funcs:
+            QAC.synthms(ms, nx*ny//4, nz)
+        (pc, imsize, pixel) = qac_image_desc(cube)
+        jobs = {
+            'stats'      : ('qac_stats',      (cube,), {}),
+            'stats_fits' : ('qac_stats',      (base + '.fits',), {}),
+            'stats_ms'   : ('qac_stats',      (ms,), {}),
+            'fits'       : ('qac_fits',       (cube, base + '.out.fits'), {'direct' : True}),
+            'im_ptg'     : ('qac_im_ptg',     (pc, imsize, pixel, 10*pixel), {}),
+            'image_desc' : ('qac_image_desc', (cube,), {}),
+            'line'       : ('qac_line',       (cube,), {}),
+            'ingest'     : ('qac_ingest',     (cube, base + '.ingest.im'), {}),
+        }
+        for f in funcs:
+            if not f in jobs:
+                print("qac_bench: unknown benchmark %s, skipped" % f)
+                continue
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork')) as pool:
+                row = pool.submit(qac_bench_run, *jobs[f]).result()
+            row['bench'] = f
+            row['size'] = [nx, ny, nz]
+            results.append(row)
+            print("QAC_BENCH: %-10s %dx%dx%d %.3f %.3f %d %d %s" %
+                  (f, nx, ny, nz, row['wall'], row['cpu'], row['bytes'], row['peak'], "" if row['ok'] else row['error']))
+
+    if outfile != None:
+        out = {'label' : label, 'version' : _version, 'host' : socket.gethostname(),
+               'date' : time.strftime('%Y-%m-%dT%H:%M:%S'), 'results' : results}
+        with open(outfile, 'w') as fp:
+            json.dump(out, fp, indent=1, default=str)
+    if not keep:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+    #-end of qac_bench()
+
+def qac_bench_run(func, args, kwargs):
+    """ worker for qac_bench(): run one qac function and measure it
+        The peak memory is reset first (linux 4.0 and up), else it includes the parent process.
+    """
+    QAC.peakreset()
+    rss0 = QAC.vmstat('VmRSS')
+    io0 = QAC.iocount()
+    t0 = time.time()
+    c0 = time.process_time()
+    row = {'func' : func, 'ok' : True, 'error' : ''}
+    try:
+        globals()[func](*args, **kwargs)
+    except Exception as e:
+        row['ok'] = False
+        row['error'] = repr(e)
+    row['wall'] = time.time() - t0
+    row['cpu'] = time.process_time() - c0
+    row['bytes'] = QAC.iocount() - io0
+    row['rss'] = rss0
+    row['peak'] = QAC.vmstat('VmHWM')
+    return row
+
+    #-end of qac_bench_run()
     
 
 
@@ -813,7 +2448,8 @@ def qac_noise(noise, *args, **kwargs):
     # rename the output from qac_clean1 so that the image is saved if the user saves it for other iterations
     os.system('mv %s/dirtymap.image %s/zero_dirtymap.image'%(args[0], args[0]))
     # remove the other output since it is not needed
-    os.system('rm -fr %s/dirtymap.*'%(args[0]))
+    for f in glob.glob('%s/dirtymap.*'%(args[0])):
+        QAC.rmasync(f)
     # calculate scale factor  @todo   rms or sigma???
     sn_scale_factor = noise / imstat('%s/zero_dirtymap.image'%(args[0]))['rms'][0]     
 
@@ -873,16 +2509,24 @@ def qac_getkey(key=None):
 
     
 
-def qac_begin(label="QAC", log=True, plot=False, local=False):
+def qac_begin(label="QAC", log=True, plot=False, local=False, tune="tclean", monitor=None, port=None, interval=10.0):
     """
     Every script should start with qac_begin() if you want to use the logger
-    and/or Dtime output for performance checking.
+    and/or QACtime output for performance checking.
     You can safely leave this call out, or set log=False
 
-    label      prefix for Dtime labeling
+    label      prefix for QACtime labeling, and basename of the timeline
     log        Use logger ?
     plot       if True, force plots to show up interactively.
     local      if a local tp2vis.py exists, execfile it  (does not work)
+    tune       apply the qac_tune() profile of this task on this host, if there is one.
+               OMP_NUM_THREADS is set for all CASA processes started from here on (e.g.
+               qac_clean_parallel), but since the running CASA already has its threads, a
+               warning is given if it differs. Use None to skip.
+    monitor    if given, the Prometheus style metrics file a background QACmonitor keeps up to
+               date (stage, CASA task, tclean cycle, elapsed time, CPU, memory, I/O) every
+               interval seconds. $QAC_MONITOR can also be used to set it.
+    port       if given, also serve the metrics on http://127.0.0.1:port/metrics
 
     See also qac_tag() and qac_end()
     """
@@ -893,9 +2537,18 @@ def qac_begin(label="QAC", log=True, plot=False, local=False):
             tp2vis_version()
 
     qac_initkeys()      # QAC.keys = {}
+
+    if tune != None and os.path.exists(QAC.tuneprofile):
+        import json, socket
+        with open(QAC.tuneprofile) as fp:
+            QAC.tuning = json.load(fp).get(socket.gethostname(), {})
+        nt = QAC.tuned(tune, 'threads')
+        if nt != None:
+            if os.environ.get('OMP_NUM_THREADS', '') != str(nt):
+                print("qac_begin: qac_tune profile for %s wants OMP_NUM_THREADS=%d, restart CASA with it for this session" % (tune, nt))
+            os.environ['OMP_NUM_THREADS'] = str(nt)
     
     if log:
-        from utils import Dtime
         import logging
         # @todo until the logging + print problem solved, this is disabled
         logging.basicConfig(level = logging.INFO)
@@ -905,15 +2558,25 @@ def qac_begin(label="QAC", log=True, plot=False, local=False):
         handler = root_logger.handlers[0]
         print('handler stream:', handler.stream)
         print('sys.stderr:', sys.stderr)
-        QAC.dt = Dtime.Dtime(label)
+        QAC.dt = QACtime(label)
+
+    if monitor == None:
+        monitor = os.environ.get('QAC_MONITOR', None)
+    if monitor != None:
+        if QAC.monitor != None:
+            QAC.monitor.stop()
+        QAC.monitor = QACmonitor(monitor, casalog.logfile(), interval, port)
+        QAC.monitor.start()
 
     print("CASA_logfile: %s" % casalog.logfile())
 
-def qac_end():
+def qac_end(outfile=None, logperf=False):
     """
     Ending your QAC script.
     
-    Stops logging and calls Dtime.end()
+    Stops logging and writes the qac_tag() timeline in <outfile>.time.json and .time.csv
+    outfile     basename of the timeline. Default: the label given to qac_begin()
+    logperf     if True, also write the qac_logperf() table of the CASA log in <outfile>.log.csv
     
     See also qac_begin()
     """
@@ -923,18 +2586,248 @@ def qac_end():
     
     if QAC.hasdt():
         QAC.dt.tag("done")
-        QAC.dt.end()
+        QAC.dt.end(outfile)
+
+    if QAC.monitor != None:
+        QAC.monitor.stop()
+        QAC.monitor = None
+
+    qac_scratch_done()
+    QAC.rmflush()
+
+    if logperf:
+        if outfile == None:
+            outfile = QAC.dt.label if QAC.hasdt() else 'QAC'
+        qac_logperf(casalog.logfile(), outfile + '.log.csv')
+
+    if len(QAC.calls) > 0:
+        qac_instrument_report()
         
+def qac_instrument(on=True):
+    """
+    Opt-in instrumentation of all qac_* functions and QAC static methods. Each call records
+    the call count, cumulative and maximum wall time, the self time (without the time in other
+    instrumented calls), the bytes read by this process, and for the qac_* functions the bytes
+    written, as the growth of the files and directories named in the (string) arguments.
+    qac_end() prints a ranked summary, see qac_instrument_report()
+
+    on       True to instrument, False to restore the original functions (the counts are kept)
+    """
+    import functools, threading
+    skip = ['qac_instrument', 'qac_instrument_report', 'qac_begin', 'qac_end', 'qac_tag', 'qac_tag_push', 'qac_tag_pop']
+    skipm = ['iocount', 'vmstat', 'dirsize', 'hasdt']
+    g = globals()
+    if not on:
+        for (name, func) in QAC.wrapped.items():
+            if name.startswith('QAC.'):
+                setattr(QAC, name[4:], staticmethod(func))
+            else:
+                g[name] = func
+        QAC.wrapped = {}
+        return
+    local = threading.local()           # each thread (e.g. in qac_feather) has its own call stack
+
+    def wrap(func, name, files):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if files:
+                paths = [a for a in list(args) + list(kwargs.values()) if type(a) == type("") and os.path.exists(a)]
+                size0 = dict([(a, QAC.dirsize(a)) for a in paths])
+            io0 = QAC.iocount()
+            if not hasattr(local, 'stack'):
+                local.stack = []
+            stack = local.stack
+            stack.append(0.0)
+            t0 = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                dt = time.time() - t0
+                inner = stack.pop()
+                if len(stack) > 0:
+                    stack[-1] += dt
+                c = QAC.calls.setdefault(name, {'n' : 0, 'cum' : 0.0, 'self' : 0.0, 'max' : 0.0, 'read' : 0, 'written' : 0})
+                c['n'] += 1
+                c['cum'] += dt
+                c['self'] += dt - inner
+                c['max'] = max(c['max'], dt)
+                c['read'] += QAC.iocount() - io0
+                if files:
+                    for a in [a for a in list(args) + list(kwargs.values()) if type(a) == type("")]:
+                        if os.path.exists(a):
+                            c['written'] += max(0, QAC.dirsize(a) - size0.get(a, 0))
+        return wrapper
+
+    for name in [n for n in g.keys() if n.startswith('qac_') and not n in skip]:
+        if callable(g[name]) and not name in QAC.wrapped:
+            QAC.wrapped[name] = g[name]
+            g[name] = wrap(g[name], name, True)
+    for (name, attr) in list(vars(QAC).items()):
+        if isinstance(attr, staticmethod) and not name in skipm and not 'QAC.' + name in QAC.wrapped:
+            QAC.wrapped['QAC.' + name] = attr.__func__
+            setattr(QAC, name, staticmethod(wrap(attr.__func__, 'QAC.' + name, False)))
+    print("qac_instrument: %d functions instrumented" % len(QAC.wrapped))
+
+    #-end of qac_instrument()
+
+def qac_instrument_report(top=20, outfile=None):
+    """
+    Print the hot spots found by qac_instrument(), ranked by self time
+    top      number of functions to print
+    outfile  optional .json or .csv table of all instrumented functions that were called
+
+    Returns the table, a list of dictionaries
+    """
+    table = [dict(name=k, **v) for (k, v) in QAC.calls.items()]
+    table.sort(key=lambda r: r['self'], reverse=True)
+    print("QAC_HOT: %-28s %8s %10s %10s %10s %12s %12s" % ('name', 'calls', 'self', 'cum', 'max', 'read', 'written'))
+    for r in table[:top]:
+        print("QAC_HOT: %-28s %8d %10.3f %10.3f %10.3f %12d %12d" %
+              (r['name'], r['n'], r['self'], r['cum'], r['max'], r['read'], r['written']))
+    if outfile != None:
+        QAC.writetable(table, outfile)
+    return table
+
+    #-end of qac_instrument_report()
+
+def qac_logperf(logfile=None, outfile=None, verbose=True):
+    """
+    Timing table of the tasks in a CASA log, read line by line so any size log will do.
+
+    For each task (Begin Task/End Task) it records the start, end, duration and the number
+    of warnings (WARN and SEVERE). For tclean also each major and minor cycle, with the
+    iterations done in a minor cycle. Warnings about a blank PSF (SIImageStore) are counted
+    separately, as these point to empty channels.
+
+    logfile    CASA log. Default: the current casalog.logfile()
+    outfile    optional .json or .csv table
+    verbose    print a QAC_LOGPERF line per task
+
+    Returns the table, a list of dictionaries with kind ('task', 'major', 'minor'), name, task,
+    start, end, time (sec), iter, major and minor (number of cycles of a task), warnings and blankpsf.
+    """
+    import re, datetime
+    if logfile == None:
+        logfile = casalog.logfile()
+    re_begin = re.compile(QAC.logre['begin'])
+    re_end   = re.compile(QAC.logre['end'])
+    re_major = re.compile(QAC.logre['major'])
+    re_minor = re.compile(QAC.logre['minor'])
+    re_iter  = re.compile(QAC.logre['iter'])
+
+    def row(kind, name, task, t):
+        return {'kind' : kind, 'name' : name, 'task' : task, 'start' : t, 'end' : None,
+                'time' : 0.0, 'iter' : 0, 'major' : 0, 'minor' : 0, 'warnings' : 0, 'blankpsf' : 0}
+
+    def close(r, t):
+        r['end'] = t
+        if r['start'] != None and t != None:
+            r['time'] = (t - r['start']).total_seconds()
+
+    table = []
+    tasks = []          # stack of running tasks
+    cycle = None        # current tclean cycle
+    t = None
+    with open(logfile, errors='replace') as fp:
+        for line in fp:
+            w = line.split('\t', 3)
+            if len(w) < 4:
+                continue
+            try:
+                t = datetime.datetime.strptime(w[0][:19], '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                continue
+            msg = w[3]
+            if w[1] in ['WARN', 'SEVERE']:
+                for r in tasks + ([cycle] if cycle != None else []):
+                    r['warnings'] += 1
+                    if 'PSF is blank' in msg or 'SIImageStore' in w[2]:
+                        r['blankpsf'] += 1
+            if 'Task:' in msg:
+                m = re_begin.search(msg)
+                if m:
+                    tasks.append(row('task', m.group(1), m.group(1), t))
+                    table.append(tasks[-1])
+                    continue
+                m = re_end.search(msg)
+                if m:
+                    if cycle != None:
+                        close(cycle, t)
+                        cycle = None
+                    for i in range(len(tasks)-1, -1, -1):
+                        if tasks[i]['name'] == m.group(1):
+                            close(tasks[i], t)
+                            del tasks[i]
+                            break
+                    continue
+            if len(tasks) == 0:
+                continue
+            task = tasks[-1]['name']
+            m = re_major.search(msg)
+            if m:
+                if cycle != None:
+                    close(cycle, t)
+                cycle = row('major', 'major%s' % m.group(2), task, t)
+                table.append(cycle)
+                tasks[-1]['major'] += 1
+                continue
+            m = re_minor.search(msg)
+            if m:
+                if cycle != None:
+                    close(cycle, t)
+                cycle = row('minor', m.group(1), task, t)
+                table.append(cycle)
+                tasks[-1]['minor'] += 1
+                continue
+            m = re_iter.search(msg)
+            if m and cycle != None:
+                cycle['iter'] += int(m.group(1))
+                if len(tasks) > 0:
+                    tasks[-1]['iter'] += int(m.group(1))
+    # whatever is still open ran until the end of the log
+    for r in tasks + ([cycle] if cycle != None else []):
+        close(r, t)
+
+    for r in table:
+        for k in ['start', 'end']:
+            r[k] = r[k].isoformat() if r[k] != None else ''
+    if verbose:
+        for r in table:
+            if r['kind'] != 'task':
+                continue
+            print("QAC_LOGPERF: %-12s %s %9.1f sec  %d major %d minor %d iter %d warnings %d blankpsf" %
+                  (r['name'], r['start'], r['time'], r['major'], r['minor'], r['iter'], r['warnings'], r['blankpsf']))
+    if outfile != None:
+        QAC.writetable(table, outfile)
+    return table
+
+    #-end of qac_logperf()
+
 def qac_tag(label):
     """
-    Create a time/memory tag for the logger using  Dtime.tag()
+    Create a time/memory tag for the logger using QACtime.tag()
     Usually called by QAC routines, not by user scripts.
     
-    See also qac_begin()
+    See also qac_begin(), qac_tag_push()
     """
     if QAC.hasdt(): 
         QAC.dt.tag(label)
 
+def qac_tag_push(stage):
+    """
+    Start a stage: the qac_tag()'s until qac_tag_pop() are nested in it,
+    and the pop records the total time/memory of the stage.
+    """
+    if QAC.hasdt():
+        QAC.dt.push(stage)
+
+def qac_tag_pop():
+    """
+    End the stage started by qac_tag_push()
+    """
+    if QAC.hasdt():
+        QAC.dt.pop()
+
 # Now a convenience class to contain some static methods    
 
 class QAC(object):
@@ -942,7 +2835,16 @@ class QAC(object):
 
         rmcasa
         iscasa
-        casa2np
+        casa2np, fits2np, boxz
+        iocount, vmstat, peakreset, writetable, ptgwrite, footprint
+        synthcube, synthms
+        beam, beamft, beamq, kernelft, target, smooth, fitsheader
+        dsid, cachekey, codehash, cacheget, cacheput
+        chanchunks, tuned
+        rmpath, dirsize, artifactprune
+        rmasync, rmflush, scratchbase
+        chunks
+        acc_init, acc_add, acc_merge, acc_stats
         imsize2
         assertf
         maxofiles
@@ -967,6 +2869,43 @@ class QAC(object):
         """
         return (x,y)
     
+    @staticmethod
+    def chanchunks(kwargs, nchunk):
+        """ split the channels of a cube tclean() in nchunk ranges
+            Returns a list of (c0, c1, kwargs) where c0..c1-1 are the channels, and kwargs
+            has a new nchan, start and imagename (imagename.chunk<N>) for that range
+        """
+        nchan = kwargs['nchan']
+        start = kwargs['start']
+        width = kwargs['width']
+        nchunk = max(1, min(nchunk, nchan))
+        edges = np.linspace(0, nchan, nchunk+1).astype(int)
+        chunks = []
+        for k in range(nchunk):
+            (c0, c1) = (int(edges[k]), int(edges[k+1]))
+            kw = dict(kwargs)
+            kw['imagename'] = '%s.chunk%d' % (kwargs['imagename'], k)
+            kw['nchan'] = c1 - c0
+            if type(start) == type(0):
+                kw['start'] = int(start + c0*width)
+            else:
+                q = qa.add(qa.quantity(start), qa.mul(qa.quantity(width), c0))
+                kw['start'] = '%r%s' % (q['value'], q['unit'])
+            chunks.append((c0, c1, kw))
+        return chunks
+
+    @staticmethod
+    def tuned(task, key=None, default=None):
+        """ return the qac_tune() profile of a task on this host, or one key from it
+            qac_begin() loads the profiles in QAC.tuning
+        """
+        entry = QAC.tuning.get(task, None)
+        if key == None:
+            return entry
+        if entry == None:
+            return default
+        return entry.get(key, default)
+
     @staticmethod
     def hasdt():
         if dir(QAC).count('dt') == 0: return False
@@ -994,10 +2933,79 @@ class QAC(object):
     @staticmethod
     def rmcasa(filename):
         if QAC.iscasa(filename):
-            os.system('rm -rf %s' % filename)
+            QAC.rmasync(filename)
         else:
             print("Warning: %s is not a CASA dataset" % filename)
 
+    # scratch space, see qac_scratch()
+    scratchdir = os.environ.get('QAC_SCRATCH', os.environ.get('TMPDIR', None))
+    scratchmax = int(float(os.environ.get('QAC_SCRATCH_MAX', 0)))   # 0 means 80% of the free space
+    scratchroot = None              # our own directory in scratchdir
+    scratch = {}                    # scratch product -> final filename (or None)
+    scratchcount = 0                # only goes up, so scratch names are never reused
+
+    @staticmethod
+    def scratchbase():
+        """ return (and create) the scratch directory of this process, None if there is no scratch space
+        """
+        if QAC.scratchroot == None and QAC.scratchdir != None and os.path.isdir(QAC.scratchdir):
+            QAC.scratchroot = tempfile.mkdtemp(prefix='qac_%d_' % os.getpid(), dir=QAC.scratchdir)
+        return QAC.scratchroot
+
+    # background deletion, see QAC.rmasync() and QAC.rmflush()
+    deleter = None                  # thread pool
+    deletions = []                  # pending deletions
+    trashdirs = set()
+    rmthreads = 4
+    rmpid = os.getpid()             # forked workers do not have the deleter threads
+
+    @staticmethod
+    def rmasync(filename):
+        """ remove a file or directory tree in the background. A directory is first renamed into
+            a .qac_trash directory next to it, so the name is free at once, and then removed by
+            one of QAC.rmthreads threads. If the rename fails (e.g. a mount point) it is removed
+            here and now. Use QAC.rmflush() to wait for all removals.
+            In a forked worker (e.g. of qac_pipeline) the threads of the parent are not there,
+            and the worker may exit before they are done, so it is also removed here and now.
+        """
+        if not os.path.lexists(filename):
+            return
+        if os.getpid() != QAC.rmpid:
+            QAC.rmpath(filename)
+            return
+        if os.path.islink(filename) or not os.path.isdir(filename):
+            os.remove(filename)
+            return
+        trash = os.path.join(os.path.dirname(os.path.abspath(filename)), '.qac_trash')
+        try:
+            os.makedirs(trash, exist_ok=True)
+            target = tempfile.mkdtemp(prefix=os.path.basename(filename.rstrip('/')) + '.', dir=trash)
+            os.rename(filename, os.path.join(target, 'x'))
+        except OSError:
+            QAC.rmpath(filename)
+            return
+        QAC.trashdirs.add(trash)
+        if QAC.deleter == None:
+            from concurrent.futures import ThreadPoolExecutor
+            QAC.deleter = ThreadPoolExecutor(max_workers=QAC.rmthreads, thread_name_prefix='qac_rm')
+        QAC.deletions.append(QAC.deleter.submit(shutil.rmtree, target, True))
+
+    @staticmethod
+    def rmflush():
+        """ wait for all the QAC.rmasync() removals, and remove the (empty) trash directories
+        """
+        if os.getpid() != QAC.rmpid:
+            return
+        for job in QAC.deletions:
+            job.result()
+        QAC.deletions = []
+        for trash in QAC.trashdirs:
+            try:
+                os.rmdir(trash)
+            except OSError:
+                pass
+        QAC.trashdirs = set()
+
     @staticmethod
     def iscasa(filename, casatype=None):
         """is a file a casa image
@@ -1031,17 +3039,22 @@ class QAC(object):
         and also native matplotlib routines, such that imshow(origin='lower')
         will give the correct orientation.
 
-        if image is a string, it's assumed to be the casa image name
+        if image is a string, it's assumed to be the casa image name, and only
+        the requested box and/or plane are read from disk
 
-        box    pixel list of [xmin,ymin, xmax, ymax]
-        z      which plane to pick in case it's a cube (not implemented)
+        box    pixel list of [xmin,ymin, xmax, ymax], or the same as a string 'xmin,ymin,xmax,ymax'
+        z      which plane to pick in case it's a cube
         """
         if type(image)==type(""):
             tb.open(image)
-            d1 = tb.getcol("map").squeeze()            
+            shape = QAC.iarray(tb.getcolshapestring("map")[0][1:-1])
+            (blc,trc) = QAC.boxz(shape, box, z)
+            d1 = tb.getcellslice("map", 0, blc, trc).squeeze()
             tb.close()
             return np.flipud(np.rot90(d1))
-        return np.flipud(np.rot90(image))
+        (blc,trc) = QAC.boxz(image.shape, box, z)
+        d1 = image[tuple([slice(b,t+1) for (b,t) in zip(blc,trc)])].squeeze()
+        return np.flipud(np.rot90(d1))
 
     @staticmethod    
     def fits2np(image, box=None, z=None):
@@ -1051,15 +3064,670 @@ class QAC(object):
         and also native matplotlib routines, such that imshow(origin='lower')
         will give the correct orientation.
 
-        if image is a string, it's assumed to be the casa image name
+        if image is a string, it's assumed to be the fits file name, which is memory
+        mapped, and a view of the requested box and/or plane is returned
 
-        box    pixel list of [xmin,ymin, xmax, ymax]
-        z      which plane to pick in case it's a cube (not implemented)
+        box    pixel list of [xmin,ymin, xmax, ymax], or the same as a string 'xmin,ymin,xmax,ymax'
+        z      which plane to pick in case it's a cube
         """
         if type(image)==type(""):
-            hdu = fits.open(image)
-            return hdu[0].data
-        return np.flipud(np.rot90(image))
+            hdu = fits.open(image, memmap=True)
+            data = hdu[0].data
+            if box == None and z == None:
+                return data
+            # numpy has the axes in reverse order from fits/casa
+            shape = data.shape[::-1]
+            (blc,trc) = QAC.boxz(shape, box, z)
+            sl = [slice(b,t+1) for (b,t) in zip(blc,trc)]
+            if z != None:
+                # drop the axis of the plane, like casa2np() does
+                for i in range(2,len(shape)):
+                    if shape[i] > 1:
+                        sl[i] = z
+                        break
+            return data[tuple(sl[::-1])]
+        (blc,trc) = QAC.boxz(image.shape, box, z)
+        d1 = image[tuple([slice(b,t+1) for (b,t) in zip(blc,trc)])].squeeze()
+        return np.flipud(np.rot90(d1))
+
+    @staticmethod
+    def boxz(shape, box=None, z=None):
+        """ return the (blc,trc) (inclusive, casa axis order) for a box and plane in an image of given shape
+            The plane z is taken along the first axis after x,y that has more than one pixel.
+
+            box    pixel list of [xmin,ymin, xmax, ymax], or the same as a string
+            z      plane number
+        """
+        blc = [0] * len(shape)
+        trc = [n-1 for n in shape]
+        if box != None:
+            if type(box) == type(""):
+                box = QAC.iarray(box)
+            blc[0:2] = box[0:2]
+            trc[0:2] = box[2:4]
+        if z != None:
+            for i in range(2,len(shape)):
+                if shape[i] > 1:
+                    blc[i] = z
+                    trc[i] = z
+                    break
+        return (blc,trc)
+
+    # on-disk cache, see QAC.cacheget() and QAC.cacheput()
+    cachedir = os.environ.get('QAC_CACHE', os.path.expanduser('~/.cache/qac'))
+    cachemax = 64*1024*1024          # bytes per kind of cache, least recently used are evicted
+
+    artifactmax = 100*1024**3       # bytes for the qac_cache() artifacts
+    tuneprofile = os.path.join(cachedir, 'tune.json')   # qac_tune() results per host and task
+    tuning = {}                     # the qac_tune() profiles of this host, see qac_begin()
+    historydb = os.environ.get('QAC_HISTORY', os.path.join(cachedir, 'history.db'))   # qac_stats(history=)
+    historysql = ('CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY, dataset TEXT, casa TEXT, host TEXT, '
+                  'date TEXT, stage TEXT, mean REAL, rms REAL, min REAL, max REAL, flux REAL, sratio REAL, '
+                  'wall REAL, stagewall REAL, peak INTEGER)')
+    calls = {}                      # qac_instrument() counters per function
+    logre = {'begin' : r'Begin Task: (\w+)',                   # CASA log patterns, see qac_logperf()
+             'end'   : r'End Task: (\w+)',
+             'major' : r'Run (\(Last\) )?Major Cycle (\d+)',
+             'minor' : r'Run (\w+) minor-cycle',
+             'iter'  : r'Completed (\d+) iterations'}
+    wrapped = {}                    # qac_instrument() original functions
+    monitor = None                  # the QACmonitor started by qac_begin()
+
+    @staticmethod
+    def rmpath(filename):
+        """ remove a file, symlink or directory tree, if it exists
+        """
+        if os.path.islink(filename) or os.path.isfile(filename):
+            os.remove(filename)
+        elif os.path.isdir(filename):
+            shutil.rmtree(filename, ignore_errors=True)
+
+    @staticmethod
+    def dirsize(filename):
+        """ size in bytes of a file or directory tree (symlinks are not followed)
+        """
+        if not os.path.isdir(filename) or os.path.islink(filename):
+            return os.lstat(filename).st_size if os.path.lexists(filename) else 0
+        total = 0
+        for root, dirs, names in os.walk(filename):
+            for name in names:
+                total += os.lstat(os.path.join(root, name)).st_size
+        return total
+
+    @staticmethod
+    def artifactprune(keep=None):
+        """ evict the least recently used qac_cache() artifacts until they use at most QAC.artifactmax bytes
+            keep      key of an entry that is never evicted (e.g. the one just written)
+        """
+        adir = os.path.join(QAC.cachedir, 'artifacts')
+        entries = []
+        for key in os.listdir(adir):
+            manifest = os.path.join(adir, key, 'manifest.json')
+            if os.path.exists(manifest):
+                entries.append((os.stat(manifest).st_mtime, QAC.dirsize(os.path.join(adir, key)), key))
+        total = sum([e[1] for e in entries])
+        for (mtime, size, key) in sorted(entries):
+            if total <= QAC.artifactmax:
+                break
+            if key == keep:
+                continue
+            print("QAC_CACHE: evicting %s (%d bytes)" % (key, size))
+            QAC.rmpath(os.path.join(adir, key))
+            total -= size
+
+    @staticmethod
+    def dsid(filename):
+        """ identity of a dataset (file or directory), for use in a cache key:
+            the realpath, and the relative name, size and mtime of all files in it.
+            None if it does not exist.
+        """
+        if filename == None or not os.path.exists(filename):
+            return None
+        path = os.path.realpath(filename)
+        if not os.path.isdir(path):
+            st = os.stat(path)
+            return [path, st.st_size, st.st_mtime_ns]
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                st = os.stat(os.path.join(root, name))
+                files.append([os.path.relpath(os.path.join(root, name), path), st.st_size, st.st_mtime_ns])
+        return [path, files]
+
+    @staticmethod
+    def cachekey(args):
+        """ hash a (json serializable) list of arguments into a cache key
+        """
+        import json, hashlib
+        return hashlib.sha1(json.dumps(args, sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def codehash(funcs):
+        """ hash the byte code (and constants) of a list of functions, so a cache key changes
+            when the code does, even if _version was not updated
+        """
+        import hashlib
+        h = hashlib.sha1()
+        def add(code):
+            h.update(code.co_code)
+            for c in code.co_consts:
+                if hasattr(c, 'co_code'):
+                    add(c)                  # nested functions; their repr has an address
+                else:
+                    h.update(repr(c).encode())
+        for f in funcs:
+            f = getattr(f, '__wrapped__', f)        # see qac_instrument()
+            add(f.__code__)
+            h.update(repr((f.__defaults__, f.__kwdefaults__)).encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def cacheget(kind, key):
+        """ return the cached dictionary for this kind of cache and key, or None
+        """
+        import json
+        fn = os.path.join(QAC.cachedir, kind, key + '.json')
+        if not os.path.exists(fn):
+            return None
+        try:
+            with open(fn) as fp:
+                value = json.load(fp)
+        except:
+            return None
+        os.utime(fn)                  # mark as recently used
+        return value
+
+    @staticmethod
+    def cacheput(kind, key, value):
+        """ store a (json serializable) dictionary in the cache, and evict the least recently
+            used entries if this kind of cache is over QAC.cachemax bytes
+        """
+        import json
+        cdir = os.path.join(QAC.cachedir, kind)
+        os.makedirs(cdir, exist_ok=True)
+        fn = os.path.join(cdir, key + '.json')
+        tmp = '%s.%d.tmp' % (fn, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(value, fp, default=float)
+        os.replace(tmp, fn)
+        entries = []
+        for name in os.listdir(cdir):
+            try:
+                st = os.stat(os.path.join(cdir, name))
+            except OSError:
+                continue                # another process got there first
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum([e[1] for e in entries])
+        for (mtime, size, name) in sorted(entries):
+            if total <= QAC.cachemax:
+                break
+            try:
+                os.remove(os.path.join(cdir, name))
+            except OSError:
+                pass
+            total -= size
+
+    footprints = {}                  # in-memory cache for QAC.footprint()
+    beamfts = {}                     # in-memory cache for QAC.beamft()
+    kernelfts = {}                   # in-memory cache for QAC.kernelft()
+
+    @staticmethod
+    def beam(im, z=0, perplane=False):
+        """ return the (major,minor,pa) of the restoring beam of an open image tool, in radians
+            im        image tool
+            z         channel, only used if perplane
+            perplane  if True, the image has per-plane beams
+        """
+        if perplane:
+            b = im.restoringbeam(channel=z, polarization=0)
+        else:
+            b = im.restoringbeam()
+        if not 'major' in b:
+            return (0.0, 0.0, 0.0)
+        return (qa.convert(b['major'],'rad')['value'],
+                qa.convert(b['minor'],'rad')['value'],
+                qa.convert(b['positionangle'],'rad')['value'])
+
+    @staticmethod
+    def beamft(shape, incr, beam):
+        """ Fourier transform of a gaussian beam, normalized to 1 at the origin, on the
+            np.fft.rfft2() grid of an image of given [nx,ny] shape and [dx,dy] increments (radians).
+            beam is (major,minor,pa) in radians, with pa from north to east.
+            Results are kept in QAC.beamfts, so planes with the same beam share them.
+        """
+        key = (tuple(shape), tuple(incr), tuple(beam))
+        if key in QAC.beamfts:
+            return QAC.beamfts[key]
+        if len(QAC.beamfts) > 128:
+            QAC.beamfts.clear()
+        w = np.exp(-QAC.beamq(shape, incr, beam))
+        QAC.beamfts[key] = w
+        return w
+
+    @staticmethod
+    def beamq(shape, incr, beam):
+        """ the exponent q of the Fourier transform exp(-q) of a gaussian beam, see QAC.beamft()
+        """
+        # the sign of dx takes care that RA (east) runs opposite to x
+        u = np.fft.fftfreq(shape[0], d=incr[0])[:,np.newaxis]
+        v = np.fft.rfftfreq(shape[1], d=abs(incr[1]))[np.newaxis,:] * np.sign(incr[1])
+        (bmaj, bmin, pa) = beam
+        umaj = u*np.sin(pa) + v*np.cos(pa)
+        umin = u*np.cos(pa) - v*np.sin(pa)
+        return np.pi**2 / (4*math.log(2.0)) * ((bmaj*umaj)**2 + (bmin*umin)**2)
+
+    @staticmethod
+    def kernelft(shape, incr, beam, target):
+        """ Fourier transform of the gaussian kernel that smooths an image with a given beam
+            to a target beam, on the np.fft.rfft2() grid (see QAC.beamft).
+            The kernel has unit sum, i.e. the transform is 1 at the origin.
+            Results are kept in QAC.kernelfts, so products smoothed to the same resolution share them.
+        """
+        key = (tuple(shape), tuple(incr), tuple(beam), tuple(target))
+        if key in QAC.kernelfts:
+            return QAC.kernelfts[key]
+        if len(QAC.kernelfts) > 128:
+            QAC.kernelfts.clear()
+        q = QAC.beamq(shape, incr, target) - QAC.beamq(shape, incr, beam)
+        if q.min() < -1e-6 * q.max():
+            raise ValueError("QAC.kernelft: target beam %s is smaller than the image beam %s" % (str(target), str(beam)))
+        w = np.exp(-np.maximum(q, 0.0))
+        QAC.kernelfts[key] = w
+        return w
+
+    @staticmethod
+    def target(smooth):
+        """ convert a resolution in arcsec (circular beam), or (major,minor,pa) in arcsec,arcsec,deg,
+            into a (major,minor,pa) beam in radians
+        """
+        if np.isscalar(smooth):
+            smooth = (smooth, smooth, 0.0)
+        return (smooth[0]/_apr, smooth[1]/_apr, smooth[2]*np.pi/180.0)
+
+    @staticmethod
+    def smooth(data, incr, beam, target, jybeam=True):
+        """ smooth one plane data[x,y,...] with a given beam to a target beam, using FFTs
+            (zero padded to avoid wrap around). NaN pixels stay NaN.
+
+            incr      [dx,dy] in radians
+            beam      (major,minor,pa) of data in radians, (0,0,0) if it has no beam
+            target    (major,minor,pa) in radians
+            jybeam    if True, the data are in Jy/beam and are scaled to Jy per target beam
+        """
+        (nx, ny) = data.shape[:2]
+        pad = int(math.ceil(1.5 * target[0] / min(abs(incr[0]), abs(incr[1]))))
+        shape = (nx+pad, ny+pad)
+        k = QAC.kernelft(shape, incr, beam, target)
+        bad = ~np.isfinite(data)
+        f = np.fft.rfft2(np.where(bad, 0.0, data), s=shape, axes=(0,1))
+        out = np.fft.irfft2(f * k.reshape(k.shape + (1,)*(data.ndim-2)), s=shape, axes=(0,1))[:nx,:ny]
+        if jybeam and beam[0] > 0:
+            out *= target[0]*target[1] / (beam[0]*beam[1])
+        out[bad] = np.nan
+        return out.astype(data.dtype)
+
+    @staticmethod
+    def footprint(image, radius=0.0):
+        """ valid pixel footprint of an image, as used by qac_ptg_footprint()
+            The image is read once, one plane at a time, and the result is kept in QAC.footprints
+            for this session.
+
+            Returns a dictionary with the occupancy 'grid' (a boolean [x,y] array of blocks of
+            'block' pixels, True if any pixel within about radius arcsec is valid), the 'shape' in
+            pixels, and the 'refpix', 'refval' (radians) and 'incr' (radians) of the x,y axes.
+        """
+        key = QAC.cachekey([QAC.dsid(image), radius])
+        if key in QAC.footprints:
+            return QAC.footprints[key]
+        im = casatools.image()
+        im.open(image)
+        h = im.summary()
+        shape = list(h['shape'])
+        valid = np.zeros(shape[:2], dtype=bool)
+        for blc,trc in QAC.chunks(shape, QAC.specaxis(h)):
+            data = im.getchunk(blc, trc, dropdeg=False)
+            ok = np.isfinite(data) & im.getchunk(blc, trc, getmask=True, dropdeg=False) & (data != 0)
+            valid |= ok.reshape(ok.shape[0], ok.shape[1], -1).any(axis=2)
+        im.close()
+        # coarse occupancy grid in blocks of about radius
+        pix = abs(h['incr'][1]) * _apr
+        block = max(1, int(radius / pix))
+        (nx, ny) = shape[:2]
+        (nbx, nby) = (-(-nx // block), -(-ny // block))
+        grid = np.zeros((nbx*block, nby*block), dtype=bool)
+        grid[:nx,:ny] = valid
+        grid = grid.reshape(nbx, block, nby, block).any(axis=(1,3))
+        if radius > 0:
+            # also accept the neighbouring blocks
+            g = np.pad(grid, 1)
+            grid = np.zeros_like(grid)
+            for i in range(3):
+                for j in range(3):
+                    grid |= g[i:i+nbx, j:j+nby]
+        fp = {'grid'   : grid,
+              'block'  : block,
+              'shape'  : shape[:2],
+              'refpix' : list(h['refpix'][:2]),
+              'refval' : list(h['refval'][:2]),
+              'incr'   : list(h['incr'][:2])}
+        QAC.footprints[key] = fp
+        return fp
+
+    @staticmethod
+    def fitsheader(im, blc=None):
+        """ return an astropy fits header for an open image tool, with the WCS shifted to
+            start at pixel blc (0 based, default all 0), for use with data from im.getchunk(blc,...)
+        """
+        h = im.summary()
+        cs = im.coordsys()
+        naxis = len(h['shape'])
+        if blc == None:
+            blc = [0] * naxis
+        proj = cs.projection()['type']
+        header = fits.Header()
+        for i in range(naxis):
+            n = i + 1
+            name = h['axisnames'][i]
+            unit = h['axisunits'][i]
+            crval = h['refval'][i]
+            cdelt = h['incr'][i]
+            if name == 'Right Ascension':
+                ctype = 'RA---' + proj
+            elif name == 'Declination':
+                ctype = 'DEC--' + proj
+            elif name == 'Frequency':
+                ctype = 'FREQ'
+            elif name == 'Stokes':
+                ctype = 'STOKES'
+                unit = ''
+            else:
+                ctype = name.upper()[:8]
+            if unit == 'rad':
+                crval = crval * 180.0 / np.pi
+                cdelt = cdelt * 180.0 / np.pi
+                unit = 'deg'
+            header['CTYPE%d' % n] = ctype
+            header['CRVAL%d' % n] = crval
+            header['CDELT%d' % n] = cdelt
+            header['CRPIX%d' % n] = h['refpix'][i] + 1.0 - blc[i]
+            if unit != '':
+                header['CUNIT%d' % n] = unit
+        header['BUNIT'] = h['unit']
+        b = h['restoringbeam']
+        if 'beams' in b:
+            # per-plane beams: fits has one beam, use the first plane's
+            b = im.restoringbeam(channel=0, polarization=0)
+        if 'major' in b:
+            header['BMAJ'] = qa.convert(b['major'],'deg')['value']
+            header['BMIN'] = qa.convert(b['minor'],'deg')['value']
+            header['BPA']  = qa.convert(b['positionangle'],'deg')['value']
+        try:
+            header['RESTFRQ'] = cs.restfrequency()['value'][0]
+            header['SPECSYS'] = cs.referencecode('spectral')[0]
+        except:
+            pass
+        header['RADESYS'] = 'FK5' if cs.referencecode('direction')[0] == 'J2000' else 'ICRS'
+        header['EQUINOX'] = 2000.0
+        info = im.miscinfo()
+        if 'OBJECT' in info:
+            header['OBJECT'] = info['OBJECT']
+        header['ORIGIN'] = 'QAC %s' % _version
+        cs.done()
+        return header
+
+    @staticmethod
+    def ptgwrite(outfile, ptglist, ra=None, dec=None):
+        """ write pointings in one go, as text (one pointing per line, as for simobserve())
+            or, if outfile ends in ".npy", as a numpy (N,2) array of RA,DEC in degrees.
+
+            ptglist   list of pointings in CASA J2000 degrees format, e.g. from qac_im_ptg()
+            ra,dec    optional arrays in degrees; if not given they are parsed from ptglist
+        """
+        if outfile.endswith('.npy'):
+            if ra is None or dec is None:
+                rd = [p.split()[1:3] for p in ptglist]
+                ra  = np.array([float(r[0][:-3]) for r in rd])
+                dec = np.array([float(r[1][:-3]) for r in rd])
+            np.save(outfile, np.column_stack([ra, dec]))
+        else:
+            with open(outfile, "w") as f:
+                if len(ptglist) > 0:
+                    f.write("\n".join(ptglist) + "\n")
+
+    @staticmethod
+    def iocount(key='rchar'):
+        """ return the number of bytes read by this process so far (0 if not known, e.g. not on linux)
+            key       'rchar' for bytes read, 'wchar' for bytes written
+        """
+        try:
+            for line in open('/proc/self/io').readlines():
+                if line.startswith(key + ':'):
+                    return int(line.split()[1])
+        except:
+            pass
+        return 0
+
+    @staticmethod
+    def vmstat(key='VmHWM'):
+        """ return a memory entry (in bytes) of /proc/self/status, e.g. VmRSS or VmHWM (the peak RSS)
+            0 if not known
+        """
+        try:
+            for line in open('/proc/self/status').readlines():
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) * 1024
+        except:
+            pass
+        return 0
+
+    @staticmethod
+    def peakreset():
+        """ reset the peak RSS (VmHWM) of this process (linux 4.0 and up)
+        """
+        try:
+            with open('/proc/self/clear_refs', 'w') as fp:
+                fp.write('5')
+        except:
+            pass
+
+    @staticmethod
+    def synthcube(filename, nx, ny, nz, fits=None, noise=1.0, seed=123):
+        """ create a synthetic RA-DEC-POL-FREQ CASA image of gaussian noise with a gaussian source
+            in the center, 1 arcsec pixels, a 3 arcsec beam and a CO(1-0) restfreq.
+            It is written plane by plane, so it can be larger than memory.
+            fits      optional FITS copy of the cube
+        """
+        cs = casatools.coordsys()
+        cs = cs.newcoordsys(direction=True, spectral=True, stokes=['I'])
+        cs.setreferencevalue(value=['180deg', '15deg'], type='direction')
+        cs.setreferencepixel(value=[nx//2, ny//2], type='direction')
+        cs.setincrement(value=['-1arcsec', '1arcsec'], type='direction')
+        cs.setreferencevalue(value='115.271202GHz', type='spectral')
+        cs.setincrement(value='1MHz', type='spectral')
+        cs.setrestfrequency(value='115.271202GHz')
+        t = casatools.image()
+        QAC.rmpath(filename)
+        t.fromshape(outfile=filename, shape=[nx, ny, 1, nz], csys=cs.torecord(), overwrite=True)
+        cs.done()
+        t.setbrightnessunit('Jy/beam')
+        t.setrestoringbeam(major='3arcsec', minor='3arcsec', pa='0deg')
+        rng = np.random.default_rng(seed)
+        (x, y) = np.meshgrid(np.arange(nx) - nx//2, np.arange(ny) - ny//2, indexing='ij')
+        src = np.exp(-(x*x + y*y) / (2.0*(nx/8.0)**2))
+        for z in range(nz):
+            amp = 10.0*noise * math.exp(-0.5*((z - nz/2.0)/(nz/6.0+1))**2)
+            plane = rng.normal(0.0, noise, (nx, ny)) + amp * src
+            t.putchunk(plane.reshape(nx, ny, 1, 1), blc=[0, 0, 0, z])
+        if fits != None:
+            t.tofits(fits, overwrite=True)
+        t.done()
+
+    @staticmethod
+    def synthms(filename, nrow, nchan, nfield=2, npol=2, seed=123):
+        """ create a small synthetic MS-like table: a main table with DATA, FLAG, FLAG_ROW,
+            FIELD_ID and DATA_DESC_ID, plus the ANTENNA, DATA_DESCRIPTION, FIELD and SPECTRAL_WINDOW
+            subtables. Enough for qac_stats() and qac_msstats(), not for imaging.
+        """
+        def coldesc(vtype, ndim=0):
+            d = {'valueType' : vtype, 'dataManagerType' : 'StandardStMan', 'dataManagerGroup' : 'StandardStMan',
+                 'option' : 0, 'maxlen' : 0, 'comment' : '', 'keywords' : {}}
+            if ndim > 0:
+                d['ndim'] = ndim
+            return d
+        rng = np.random.default_rng(seed)
+        QAC.rmpath(filename)
+        t = casatools.table()
+        t.create(filename, {'DATA'         : coldesc('complex', 2),
+                            'FLAG'         : coldesc('boolean', 2),
+                            'FLAG_ROW'     : coldesc('boolean'),
+                            'FIELD_ID'     : coldesc('int'),
+                            'DATA_DESC_ID' : coldesc('int')})
+        t.addrows(nrow)
+        data = rng.normal(0, 1, (npol, nchan, nrow)) + 1j*rng.normal(0, 1, (npol, nchan, nrow))
+        t.putcol('DATA', data.astype(np.complex64))
+        t.putcol('FLAG', rng.random((npol, nchan, nrow)) < 0.01)
+        t.putcol('FLAG_ROW', np.zeros(nrow, dtype=bool))
+        t.putcol('FIELD_ID', np.arange(nrow, dtype=np.int32) % nfield)
+        t.putcol('DATA_DESC_ID', np.zeros(nrow, dtype=np.int32))
+        t.close()
+        t.create(filename + '/DATA_DESCRIPTION', {'SPECTRAL_WINDOW_ID' : coldesc('int')})
+        t.addrows(1)
+        t.putcol('SPECTRAL_WINDOW_ID', np.zeros(1, dtype=np.int32))
+        t.close()
+        t.create(filename + '/FIELD', {'NAME' : coldesc('string')})
+        t.addrows(nfield)
+        t.putcol('NAME', np.array(['F%d' % i for i in range(nfield)]))
+        t.close()
+        t.create(filename + '/ANTENNA', {'NAME' : coldesc('string')})    # qac_stats() looks for this
+        t.addrows(2)
+        t.putcol('NAME', np.array(['A0', 'A1']))
+        t.close()
+        t.create(filename + '/SPECTRAL_WINDOW', {'CHAN_WIDTH' : coldesc('double', 1)})
+        t.addrows(1)
+        t.putcol('CHAN_WIDTH', np.ones((nchan, 1)) * 1e6)
+        t.close()
+        t.done()
+
+    @staticmethod
+    def writetable(table, filename):
+        """ write a table, a list of dictionaries, as json (if filename ends in .json) or csv.
+            The columns are the union of all the keys, in order of appearance.
+        """
+        if filename.endswith('.json'):
+            import json
+            with open(filename, 'w') as fp:
+                json.dump(table, fp, indent=1, default=str)
+        else:
+            import csv
+            cols = []
+            for row in table:
+                for k in row.keys():
+                    if not k in cols:
+                        cols.append(k)
+            with open(filename, 'w', newline='') as fp:
+                w = csv.DictWriter(fp, fieldnames=cols)
+                w.writeheader()
+                for row in table:
+                    w.writerow(row)
+        print("Wrote %s" % filename)
+
+    @staticmethod
+    def specaxis(summary):
+        """ return the index of the spectral axis given an ia.summary(), -1 if none
+        """
+        for i in range(len(summary['axisnames'])):
+            if summary['axisnames'][i] == 'Frequency':
+                return i
+        return -1
+
+    @staticmethod
+    def chunks(shape, zaxis=-1, maxpix=None, zrange=None):
+        """ generate the (blc,trc) of the chunks to go through an image one plane at a time,
+            for ia.getchunk(). All axes other than x,y and the spectral axis are fully included.
+
+            shape     shape of the image, as in ia.summary()['shape']
+            zaxis     index of the spectral axis, -1 if none (see QAC.specaxis)
+            maxpix    if given, planes are further split in blocks of rows, of at most
+                      maxpix pixels (but at least one row)
+            zrange    if given, [zmin,zmax] (inclusive) range of planes
+        """
+        nx = shape[0]
+        ny = shape[1]
+        if maxpix == None:
+            rows = ny
+        else:
+            rows = max(1, int(maxpix) // nx)
+        if zaxis < 0:
+            zlist = [0]
+        elif zrange == None:
+            zlist = range(shape[zaxis])
+        else:
+            zlist = range(zrange[0], zrange[1]+1)
+        for z in zlist:
+            for y0 in range(0, ny, rows):
+                blc = [0] * len(shape)
+                trc = [n-1 for n in shape]
+                blc[1] = y0
+                trc[1] = min(y0+rows, ny) - 1
+                if zaxis >= 0:
+                    blc[zaxis] = z
+                    trc[zaxis] = z
+                yield (blc, trc)
+
+    @staticmethod
+    def acc_init():
+        """ new (empty) running accumulator for QAC.acc_add() and QAC.acc_merge()
+        """
+        return {'n' : 0, 'mean' : 0.0, 'm2' : 0.0, 'sum' : 0.0, 'last' : 0.0, 'min' : np.inf, 'max' : -np.inf}
+
+    @staticmethod
+    def acc_add(acc, data):
+        """ add an array of values to a running accumulator, returns the new accumulator.
+            The chunk mean and sum of squared deviations are merged in (the parallel form
+            of Welford's algorithm), so the variance does not suffer from cancellation.
+            acc['last'] holds the sum of just this chunk.
+        """
+        chunk = QAC.acc_init()
+        n = data.size
+        if n > 0:
+            d = data.astype(np.float64).ravel()
+            chunk['n']    = n
+            chunk['sum']  = d.sum()
+            chunk['mean'] = chunk['sum'] / n
+            chunk['m2']   = ((d - chunk['mean'])**2).sum()
+            chunk['min']  = d.min()
+            chunk['max']  = d.max()
+        new = QAC.acc_merge(acc, chunk)
+        new['last'] = chunk['sum']
+        return new
+
+    @staticmethod
+    def acc_merge(a, b):
+        """ merge two running accumulators, e.g. from different chunks or processes
+        """
+        if b['n'] == 0:
+            return dict(a)
+        if a['n'] == 0:
+            return dict(b)
+        n = a['n'] + b['n']
+        delta = b['mean'] - a['mean']
+        return {'n'    : n,
+                'mean' : a['mean'] + delta * b['n'] / n,
+                'm2'   : a['m2'] + b['m2'] + delta**2 * a['n'] * b['n'] / n,
+                'sum'  : a['sum'] + b['sum'],
+                'last' : b['last'],
+                'min'  : min(a['min'], b['min']),
+                'max'  : max(a['max'], b['max'])}
+
+    @staticmethod
+    def acc_stats(acc, ddof=1):
+        """ return (mean,sigma) of a running accumulator
+            ddof=1 gives the sample sigma (as imstat), ddof=0 the population rms (as numpy.std)
+        """
+        if acc['n'] <= ddof:
+            return (np.nan, np.nan)
+        return (acc['mean'], np.sqrt(acc['m2'] / (acc['n'] - ddof)))
 
     @staticmethod    
     def imsize2(imsize):
@@ -1153,6 +3821,244 @@ class QAC(object):
         if label != None:
             print("QAC.select %d %s %s" % (thisone,str(retval),label))
         return retval
-        
-    
+
+
+class QACtime(object):
+    """ Timing and memory profiler for qac_begin(), qac_tag() and qac_end()
+        (this replaces the Dtime from utils, which is not part of qac)
+
+        Each tag records the wall and cpu time since the previous tag, the current and peak
+        RSS of this process, and the cpu time and peak RSS of finished child processes (e.g. the
+        CASA tasks that run as processes). Tags can be nested in stages with push() and pop(),
+        which adds the totals of the stage. A push resets the peak RSS of this process (on linux),
+        so the peak of a tag is that since the start of its stage.
+        The cost is a getrusage() and a /proc read per tag.
+    """
+    def __init__(self, label="QAC", verbose=True):
+        self.label = label
+        self.verbose = verbose
+        self.stages = []
+        self.peaks = [0]
+        self.timeline = []
+        self.t0 = time.time()
+        self.last = self.now()
+        self.start = [self.last]
+
+    def now(self):
+        import resource
+        r0 = resource.getrusage(resource.RUSAGE_SELF)
+        r1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {'t'     : time.time() - self.t0,
+                'cpu'   : r0.ru_utime + r0.ru_stime,
+                'ccpu'  : r1.ru_utime + r1.ru_stime,
+                'rss'   : QAC.vmstat('VmRSS'),
+                'peak'  : r0.ru_maxrss * 1024,
+                'cpeak' : r1.ru_maxrss * 1024}
+
+    def record(self, label, since, kind):
+        n = self.now()
+        row = {'label' : label,
+               'stage' : '/'.join([self.label] + self.stages),
+               'depth' : len(self.stages),
+               'kind'  : kind,
+               't'     : n['t'],
+               'wall'  : n['t'] - since['t'],
+               'cpu'   : n['cpu'] - since['cpu'],
+               'ccpu'  : n['ccpu'] - since['ccpu'],
+               'rss'   : n['rss'],
+               'drss'  : n['rss'] - since['rss'],
+               'peak'  : n['peak'],
+               'dpeak' : n['peak'] - since['peak'],
+               'cpeak' : n['cpeak']}
+        self.timeline.append(row)
+        if self.verbose:
+            print("QAC_TIME: %s %s %s %.3f %.3f %.3f %.1f %.1f MB" %
+                  (row['stage'], kind, label, row['t'], row['wall'], row['cpu'] + row['ccpu'],
+                   row['rss']/1048576.0, row['peak']/1048576.0))
+        self.last = n
+        return row
+
+    def tag(self, label):
+        """ record the time since the previous tag """
+        return self.record(label, self.last, 'tag')
+
+    def push(self, stage):
+        """ start a (nested) stage; following tags are inside it """
+        self.tag(stage)
+        self.stages.append(stage)
+        self.start.append(self.last)
+        # the peak RSS so far goes to the enclosing stages, and the stage starts with a fresh one
+        hwm = QAC.vmstat('VmHWM')
+        self.peaks = [max(p, hwm) for p in self.peaks] + [0]
+        QAC.peakreset()
+
+    def stagepeak(self):
+        """ peak RSS (bytes) of this process since the start of the current stage, 0 if not known """
+        return max(self.peaks[-1], QAC.vmstat('VmHWM'))
+
+    def pop(self):
+        """ end the current stage and record its total """
+        if len(self.stages) == 0:
+            return None
+        since = self.start.pop()
+        stage = self.stages.pop()
+        peak = max(self.peaks.pop(), QAC.vmstat('VmHWM'))
+        self.peaks[-1] = max(self.peaks[-1], peak)
+        return self.record(stage, since, 'stage')
+
+    def end(self, outfile=None):
+        """ close all stages, record the total, and write the timeline as json and csv
+            outfile    basename of the timeline files. Default: the label
+        """
+        while len(self.stages) > 0:
+            self.pop()
+        self.record(self.label, self.start[0], 'total')
+        if outfile == None:
+            outfile = self.label
+        QAC.writetable(self.timeline, outfile + '.time.json')
+        QAC.writetable(self.timeline, outfile + '.time.csv')
+        print("QAC_TIME: timeline in %s.time.json and %s.time.csv" % (outfile, outfile))
+        return self.timeline
+
+class QACmonitor(object):
+    """ Background monitor for long QAC runs, see qac_begin(monitor=)
+
+        A thread that every interval seconds tails the CASA log (current task, tclean major
+        cycle and iterations, warnings), samples the CPU, RSS and I/O of this process, and
+        writes them, with the current qac_tag() stage, to a Prometheus style text file.
+        Optionally the same text is served on http://127.0.0.1:port/metrics
+    """
+    def __init__(self, filename, logfile=None, interval=10.0, port=None):
+        import re, threading
+        self.filename = filename
+        self.logfile = logfile
+        self.interval = interval
+        self.port = port
+        self.t0 = time.time()
+        self.task = ''
+        self.major = 0
+        self.iters = 0
+        self.warnings = 0
+        self.lastlog = self.t0
+        self.text = ''
+        self.offset = None
+        self.partial = ''
+        self.re = dict([(k, re.compile(v)) for (k, v) in QAC.logre.items()])
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='qac_monitor', daemon=True)
+        self.server = None
+
+    def start(self):
+        if self.port != None:
+            import threading
+            from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+            monitor = self
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = monitor.text.encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                def log_message(self, *args):
+                    pass
+            self.server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+            threading.Thread(target=self.server.serve_forever, name='qac_monitor_http', daemon=True).start()
+        self.thread.start()
+        print("qac_monitor: metrics in %s%s" % (self.filename, "" if self.port == None else " and on http://127.0.0.1:%d/metrics" % self.port))
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def run(self):
+        while True:
+            self.update()
+            if self.done.wait(self.interval):
+                self.update()
+                break
+
+    def tail(self):
+        """ parse the new lines in the CASA log; the first time we start at its end """
+        if self.logfile == None or not os.path.exists(self.logfile):
+            return
+        with open(self.logfile, errors='replace') as fp:
+            if self.offset == None or os.path.getsize(self.logfile) < self.offset:
+                fp.seek(0, 2)
+                self.offset = fp.tell()
+                return
+            fp.seek(self.offset)
+            data = self.partial + fp.read()
+            self.offset = fp.tell()
+        lines = data.split('\n')
+        self.partial = lines.pop()
+        if len(lines) > 0:
+            self.lastlog = time.time()
+        for line in lines:
+            w = line.split('\t', 3)
+            if len(w) < 4:
+                continue
+            if w[1] in ['WARN', 'SEVERE']:
+                self.warnings += 1
+            m = self.re['begin'].search(w[3])
+            if m:
+                self.task = m.group(1)
+                self.major = 0
+                continue
+            if self.re['end'].search(w[3]):
+                self.task = ''
+                continue
+            m = self.re['major'].search(w[3])
+            if m:
+                self.major = int(m.group(2))
+                continue
+            m = self.re['iter'].search(w[3])
+            if m:
+                self.iters += int(m.group(1))
+
+    def update(self):
+        import resource
+        try:
+            self.tail()
+        except Exception as e:
+            print("qac_monitor: cannot read %s: %s" % (self.logfile, str(e)))
+            self.logfile = None
+        r0 = resource.getrusage(resource.RUSAGE_SELF)
+        r1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        stage = ''
+        tag = ''
+        if QAC.hasdt():
+            stage = '/'.join([QAC.dt.label] + QAC.dt.stages)
+            if len(QAC.dt.timeline) > 0:
+                tag = QAC.dt.timeline[-1]['label']
+        now = time.time()
+        metrics = [
+            ('qac_up',                     'gauge',   '', 1),
+            ('qac_elapsed_seconds',        'gauge',   '', now - self.t0),
+            ('qac_cpu_seconds_total',      'counter', '', r0.ru_utime + r0.ru_stime + r1.ru_utime + r1.ru_stime),
+            ('qac_rss_bytes',              'gauge',   '', QAC.vmstat('VmRSS')),
+            ('qac_peak_rss_bytes',         'gauge',   '', max(r0.ru_maxrss, r1.ru_maxrss) * 1024),
+            ('qac_read_bytes_total',       'counter', '', QAC.iocount('rchar')),
+            ('qac_write_bytes_total',      'counter', '', QAC.iocount('wchar')),
+            ('qac_stage_info',             'gauge',   '{stage="%s",tag="%s"}' % (stage, tag), 1),
+            ('qac_casa_task_info',         'gauge',   '{task="%s"}' % self.task, 1),
+            ('qac_tclean_major_cycle',     'gauge',   '', self.major),
+            ('qac_tclean_iterations_total','counter', '', self.iters),
+            ('qac_casa_warnings_total',    'counter', '', self.warnings),
+            ('qac_log_idle_seconds',       'gauge',   '', now - self.lastlog),
+        ]
+        lines = []
+        for (name, kind, labels, value) in metrics:
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s%s %s' % (name, labels, repr(value)))
+        self.text = '\n'.join(lines) + '\n'
+        tmp = '%s.%d' % (self.filename, os.getpid())
+        with open(tmp, 'w') as fp:
+            fp.write(self.text)
+        os.replace(tmp, self.filename)
+
 #- end of qac.py